@@ -1,44 +1,121 @@
-import json
+import msgpack
+import orjson
 import time
+import uuid
 import asyncio
-import redis
+import redis.asyncio as aioredis
 import os
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Set, Tuple
 
 from events import (
     CH_STRATEGY_EVENTS, StrategySignalEvent, CandleUpdateEvent,
     OrderExecutionEvent, PositionStateEvent, TradeTerminalEvent,
-    get_signals_ch
+    get_signals_ch, get_state_key
 )
 from storage import TradeStorage
 
+# KEYS[1] - hash состояния, KEYS[2] - канал событий
+# ARGV: symbol, состояние (JSON), событие (MessagePack), "1" для HDEL вместо HSET
+_SYNC_AND_PUBLISH_LUA = """
+if ARGV[4] == '1' then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+else
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+redis.call('PUBLISH', KEYS[2], ARGV[3])
+return 1
+"""
+
+def _event(event_cls: type, **fields) -> dict:
+    """
+    Событие в виде dict с полями BaseEvent, готовое к msgpack.packb.
+    Схема задается классом из events.py, но pydantic-модель не создается.
+    """
+    return {
+        "event_id": str(uuid.uuid4()),
+        "timestamp": time.time(),
+        "event_type": event_cls.__name__,
+        **fields
+    }
+
+class Candle:
+    """Поля свечи из CandleUpdateEvent, нужные агрегатору (доступ по атрибутам вместо dict)."""
+    __slots__ = ("open", "high", "low", "close", "timestamp")
+
+    def __init__(self, open: float, high: float, low: float, close: float, timestamp: float):
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_event(cls, data: dict) -> "Candle":
+        return cls(data['open'], data['high'], data['low'], data['close'], data['timestamp'])
+
 class AggregateService:
     def __init__(self, redis_host='redis', db_path="trades.db"):
-        self.r = redis.Redis(host=redis_host, port=6379, db=0, decode_responses=True)
+        # Пул для команд (hset/publish/пайплайны); pub/sub идет через отдельный клиент
+        self.pool = aioredis.BlockingConnectionPool(
+            host=redis_host, port=6379, db=0, max_connections=32, decode_responses=True
+        )
+        self.r = aioredis.Redis(connection_pool=self.pool)
+        # События в канале закодированы MessagePack — подписка без декодирования в str
+        self.r_sub = aioredis.Redis(host=redis_host, port=6379, db=0, decode_responses=False)
+        # EVALSHA с автоматической перезагрузкой скрипта при NOSCRIPT
+        self._sync_and_publish = self.r.register_script(_SYNC_AND_PUBLISH_LUA)
         self.storage = TradeStorage(db_path)
         
-        # In-memory state: positions[strategy_id][symbol]
-        self.positions: Dict[str, Dict[str, Any]] = {}
-        # In-memory state: orders[strategy_id][symbol] (Limit orders)
-        self.orders: Dict[str, Dict[str, Any]] = {}
+        # In-memory state: positions[(strategy_id, symbol)]
+        self.positions: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # In-memory state: orders[(strategy_id, symbol)] (Limit orders)
+        self.orders: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # Ключи (strategy_id, symbol), у которых есть ордер или позиция
+        self.active: Set[Tuple[str, str]] = set()
+        # Ключи хэшей состояния: (strategy_id, 'positions' | 'orders') -> ключ Redis
+        self._state_keys: Dict[Tuple[str, str], str] = {}
+        # Очередь записей в SQLite: ("trade" | "order", payload), разбирается _writer
+        self.write_q: asyncio.Queue = asyncio.Queue()
+        self._writer_task: Optional[asyncio.Task] = None
 
     async def run(self):
-        pubsub = self.r.pubsub()
-        pubsub.subscribe(CH_STRATEGY_EVENTS)
+        pubsub = self.r_sub.pubsub()
+        await pubsub.subscribe(CH_STRATEGY_EVENTS)
+        self._writer_task = asyncio.create_task(self._writer())
         print("Aggregate Service started, listening for events...")
 
+        backoff = 1
         while True:
             try:
-                message = pubsub.get_message(ignore_subscribe_messages=True)
-                if message:
-                    data = json.loads(message['data'])
-                    await self.handle_event(data)
-                
-                await asyncio.sleep(0.01)
+                # listen() просыпается только при появлении данных в сокете, без опроса
+                async for message in pubsub.listen():
+                    backoff = 1
+                    if message['type'] != 'message':
+                        continue
+                    try:
+                        data = msgpack.unpackb(message['data'], raw=False)
+                        await self.handle_event(data)
+                    except Exception as e:
+                        # Ошибка в одном событии не должна тормозить поток остальных
+                        print(f"Error in aggregate loop: {e}")
+            except Exception as e:
+                # Сбой соединения/подписки: переподключение с экспоненциальной задержкой
+                print(f"Aggregate pubsub error: {e}, retrying in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    async def _writer(self):
+        """Единственный потребитель write_q: передает записи в TradeStorage вне горячего пути."""
+        while True:
+            kind, payload = await self.write_q.get()
+            try:
+                if kind == "trade":
+                    self.storage.save_trade(payload)
+                else:
+                    self.storage.save_order(payload)
             except Exception as e:
-                print(f"Error in aggregate loop: {e}")
-                await asyncio.sleep(1)
+                print(f"Error saving {kind}: {e}")
 
     async def handle_event(self, data: dict):
         event_type = data.get('event_type')
@@ -64,9 +141,9 @@ class AggregateService:
                 # Real fill happens on next candle, but let's assume we have a price or wait for candle.
                 # To keep it simple, we store it as a pending order if price is missing, 
                 # but we'll fill it immediately on the next candle's Open.
-                self._add_order(strategy_id, symbol, data, "MARKET")
+                await self._add_order(strategy_id, symbol, data, "MARKET")
             else:
-                self._add_order(strategy_id, symbol, data, "LIMIT")
+                await self._add_order(strategy_id, symbol, data, "LIMIT")
                 
         elif action.startswith("CLOSE"):
             pos = self._get_position(strategy_id, symbol)
@@ -77,29 +154,29 @@ class AggregateService:
     async def process_candle(self, data: dict):
         strategy_id = data['strategy_id']
         symbol = data['symbol']
-        high = data['high']
-        low = data['low']
-        close = data['close']
-        timestamp = data['timestamp']
+        # Быстрый выход: для большинства свечей нет ни ордера, ни позиции
+        if (strategy_id, symbol) not in self.active:
+            return
+        candle = Candle.from_event(data)
 
         # 1. Check pending orders
         order = self._get_order(strategy_id, symbol)
         if order:
-            await self.check_order_fill(strategy_id, symbol, order, data)
+            await self.check_order_fill(strategy_id, symbol, order, candle)
 
         # 2. Check open positions (TP/SL and PnL)
         pos = self._get_position(strategy_id, symbol)
         if pos:
             # Update unrealised PnL
-            side_mult = 1 if pos['side'] == "LONG" else -1
-            pos['unrealised_pnl'] = (close - pos['entry_price']) * pos['size'] * side_mult
+            pos['unrealised_pnl'] = pos['dir'] * (candle.close - pos['entry_price']) * pos['size']
             
             # Check for exits
-            await self.check_position_exit(strategy_id, symbol, pos, data)
+            await self.check_position_exit(strategy_id, symbol, pos, candle)
             
             # If still open, broadcast update
-            if symbol in self.positions.get(strategy_id, {}):
-                event = PositionStateEvent(
+            if (strategy_id, symbol) in self.positions:
+                event = _event(
+                    PositionStateEvent,
                     strategy_id=strategy_id,
                     symbol=symbol,
                     side=pos['side'],
@@ -109,19 +186,18 @@ class AggregateService:
                     stop_loss=pos.get('stop_loss'),
                     take_profit=pos.get('take_profit')
                 )
-                self._publish_event(event)
-                self._sync_state_to_redis(strategy_id, symbol, "positions", pos)
+                await self._publish_and_sync(strategy_id, symbol, "positions", pos, event)
 
-    async def check_order_fill(self, strategy_id: str, symbol: str, order: dict, candle: dict):
+    async def check_order_fill(self, strategy_id: str, symbol: str, order: dict, candle: Candle):
         price = order.get('price')
         filled = False
         fill_price = price
 
         if order['order_type'] == "MARKET":
             filled = True
-            fill_price = candle['open']
+            fill_price = candle.open
         else: # LIMIT
-            if candle['low'] <= price <= candle['high']:
+            if candle.low <= price <= candle.high:
                 filled = True
 
         if filled:
@@ -132,18 +208,20 @@ class AggregateService:
                 "strategy_id": strategy_id,
                 "symbol": symbol,
                 "side": side,
+                "dir": 1 if side == "LONG" else -1,  # знак для PnL и проверок TP/SL
                 "size": 1.0, # Simplified
                 "entry_price": fill_price,
-                "entry_time": candle['timestamp'],
+                "entry_time": candle.timestamp,
                 "stop_loss": order.get('stop_loss'),
                 "take_profit": order.get('take_profit'),
                 "unrealised_pnl": 0.0
             }
-            self.positions.setdefault(strategy_id, {})[symbol] = new_pos
-            self.orders[strategy_id].pop(symbol)
+            self.positions[(strategy_id, symbol)] = new_pos
+            self.orders.pop((strategy_id, symbol))
 
             # Notify
-            event = OrderExecutionEvent(
+            event = _event(
+                OrderExecutionEvent,
                 strategy_id=strategy_id,
                 symbol=symbol,
                 order_id=order['event_id'],
@@ -153,10 +231,8 @@ class AggregateService:
                 qty=1.0,
                 status="FILLED"
             )
-            self._publish_event(event)
-            
             # Save to SQLite
-            self.storage.save_order({
+            self.write_q.put_nowait(("order", {
                 "order_id": order['event_id'],
                 "strategy_id": strategy_id,
                 "symbol": symbol,
@@ -165,51 +241,44 @@ class AggregateService:
                 "qty": 1.0,
                 "type": order['order_type'],
                 "status": "FILLED"
-            })
+            }))
 
-            # Sync to Redis
-            self._sync_state_to_redis(strategy_id, symbol, "orders", None, remove=True)
-            self._sync_state_to_redis(strategy_id, symbol, "positions", new_pos)
+            # Sync to Redis (одним round-trip вместе с событием)
+            pipe = self.r.pipeline(transaction=False)
+            await self._sync_state_to_redis(strategy_id, symbol, "orders", None, remove=True, pipe=pipe)
+            await self._publish_and_sync(strategy_id, symbol, "positions", new_pos, event, pipe=pipe)
+            await pipe.execute()
 
-    async def check_position_exit(self, strategy_id: str, symbol: str, pos: dict, candle: dict):
+    async def check_position_exit(self, strategy_id: str, symbol: str, pos: dict, candle: Candle):
         sl = pos.get('stop_loss')
         tp = pos.get('take_profit')
-        side = pos['side']
+        d = pos['dir']
         exit_price = None
         reason = None
 
-        if side == "LONG":
-            if sl and candle['low'] <= sl:
-                exit_price = sl
-                reason = "SL"
-            elif tp and candle['high'] >= tp:
-                exit_price = tp
-                reason = "TP"
-        else: # SHORT
-            if sl and candle['high'] >= sl:
-                exit_price = sl
-                reason = "SL"
-            elif tp and candle['low'] <= tp:
-                exit_price = tp
-                reason = "TP"
+        # Неблагоприятный/благоприятный экстремум свечи относительно направления позиции
+        adverse, favorable = (candle.low, candle.high) if d > 0 else (candle.high, candle.low)
+        if sl and d * (adverse - sl) <= 0:
+            exit_price = sl
+            reason = "SL"
+        elif tp and d * (favorable - tp) >= 0:
+            exit_price = tp
+            reason = "TP"
 
         if exit_price:
-            await self.close_position(strategy_id, symbol, pos, exit_price, reason, candle['timestamp'])
+            await self.close_position(strategy_id, symbol, pos, exit_price, reason, candle.timestamp)
 
     async def close_position(self, strategy_id: str, symbol: str, pos: dict, price_override: Optional[float], reason: str, timestamp: float = None):
         exit_price = price_override or pos.get('last_close', pos['entry_price'])
         timestamp = timestamp or time.time()
         
         # Calculate PnL
-        if pos['side'] == "LONG":
-            pnl = (exit_price - pos['entry_price']) * pos['size']
-        else:
-            pnl = (pos['entry_price'] - exit_price) * pos['size']
+        pnl = pos['dir'] * (exit_price - pos['entry_price']) * pos['size']
 
         print(f"Position CLOSED: {strategy_id} {symbol} {reason} at {exit_price} PnL: {pnl}")
 
         # Update Storage
-        self.storage.save_trade({
+        self.write_q.put_nowait(("trade", {
             "strategy_id": strategy_id,
             "symbol": symbol,
             "side": pos['side'],
@@ -220,14 +289,16 @@ class AggregateService:
             "entry_time": pos['entry_time'],
             "exit_time": timestamp,
             "metadata": {"reason": reason}
-        })
+        }))
 
         # Remove position
-        self.positions[strategy_id].pop(symbol)
-        self._sync_state_to_redis(strategy_id, symbol, "positions", None, remove=True)
+        self.positions.pop((strategy_id, symbol))
+        if (strategy_id, symbol) not in self.orders:
+            self.active.discard((strategy_id, symbol))
 
         # Notify
-        event = TradeTerminalEvent(
+        event = _event(
+            TradeTerminalEvent,
             strategy_id=strategy_id,
             symbol=symbol,
             trigger_type=reason if reason in ["TP", "SL"] else "TP", # Field expects TP/SL literal
@@ -235,18 +306,23 @@ class AggregateService:
             pnl=pnl,
             realised_pnl=pnl
         )
-        self._publish_event(event)
+        pipe = self.r.pipeline(transaction=False)
+        await self._publish_and_sync(strategy_id, symbol, "positions", None, event, remove=True, pipe=pipe)
         
         # Also broadcast position update (FLAT)
-        update_event = PositionStateEvent(
+        update_event = _event(
+            PositionStateEvent,
             strategy_id=strategy_id,
             symbol=symbol,
             side="FLAT",
-            size=0,
-            entry_price=0,
-            unrealised_pnl=0
+            size=0.0,
+            entry_price=0.0,
+            unrealised_pnl=0.0,
+            stop_loss=None,
+            take_profit=None
         )
-        self._publish_event(update_event)
+        await self._publish_event(update_event, pipe)
+        await pipe.execute()
 
     async def update_tp_sl(self, data: dict):
         strategy_id = data['strategy_id']
@@ -257,44 +333,79 @@ class AggregateService:
             if 'take_profit' in data: pos['take_profit'] = data['take_profit']
             
             # Notify UI
-            event = PositionStateEvent(
+            event = _event(
+                PositionStateEvent,
                 strategy_id=strategy_id,
                 symbol=symbol,
                 side=pos['side'],
                 size=pos['size'],
                 entry_price=pos['entry_price'],
+                unrealised_pnl=0.0,
                 stop_loss=pos['stop_loss'],
                 take_profit=pos['take_profit']
             )
-            self._publish_event(event)
             # Sync to Redis
-            self._sync_state_to_redis(strategy_id, symbol, "positions", pos)
+            await self._publish_and_sync(strategy_id, symbol, "positions", pos, event)
 
-    def _add_order(self, strategy_id: str, symbol: str, data: dict, order_type: str):
-        if strategy_id not in self.orders:
-            self.orders[strategy_id] = {}
+    async def _add_order(self, strategy_id: str, symbol: str, data: dict, order_type: str):
         data['order_type'] = order_type
-        self.orders[strategy_id][symbol] = data
-        self._sync_state_to_redis(strategy_id, symbol, "orders", data)
+        self.orders[(strategy_id, symbol)] = data
+        self.active.add((strategy_id, symbol))
+        await self._sync_state_to_redis(strategy_id, symbol, "orders", data)
 
     def _get_order(self, strategy_id: str, symbol: str) -> Optional[dict]:
-        return self.orders.get(strategy_id, {}).get(symbol)
+        return self.orders.get((strategy_id, symbol))
 
     def _get_position(self, strategy_id: str, symbol: str) -> Optional[dict]:
-        return self.positions.get(strategy_id, {}).get(symbol)
+        return self.positions.get((strategy_id, symbol))
 
-    def _publish_event(self, event: Any):
-        self.r.publish(CH_STRATEGY_EVENTS, event.json())
+    def _state_key(self, strategy_id: str, state_type: str) -> str:
+        key = self._state_keys.get((strategy_id, state_type))
+        if key is None:
+            key = self._state_keys[(strategy_id, state_type)] = get_state_key(strategy_id, state_type)
+        return key
 
-    def _sync_state_to_redis(self, strategy_id: str, symbol: str, state_type: str, data: Any, remove: bool = False):
+    async def _publish_event(self, event: dict, pipe: Optional[aioredis.client.Pipeline] = None):
+        """
+        pipe: если передан, команда ставится в очередь пайплайна (execute делает вызывающий)
+        """
+        if pipe is not None:
+            pipe.publish(CH_STRATEGY_EVENTS, msgpack.packb(event, use_bin_type=True))
+        else:
+            await self.r.publish(CH_STRATEGY_EVENTS, msgpack.packb(event, use_bin_type=True))
+
+    async def _publish_and_sync(self, strategy_id: str, symbol: str, state_type: str, data: Any, event: dict,
+                                remove: bool = False, pipe: Optional[aioredis.client.Pipeline] = None):
+        """
+        HSET/HDEL состояния и PUBLISH события одним атомарным вызовом Lua-скрипта.
+        pipe: если передан, в очередь пайплайна ставятся обычные HSET/HDEL и PUBLISH
+        (execute делает вызывающий). Script на пайплайне перед отправкой делает
+        SCRIPT EXISTS — лишний round-trip на каждое исполнение ордера/закрытие.
+        """
+        if pipe is not None:
+            await self._sync_state_to_redis(strategy_id, symbol, state_type, data, remove=remove, pipe=pipe)
+            await self._publish_event(event, pipe)
+            return
+        key = self._state_key(strategy_id, state_type)
+        args = [symbol, b"" if remove else orjson.dumps(data), msgpack.packb(event, use_bin_type=True), "1" if remove else "0"]
+        await self._sync_and_publish(keys=[key, CH_STRATEGY_EVENTS], args=args)
+
+    async def _sync_state_to_redis(self, strategy_id: str, symbol: str, state_type: str, data: Any, remove: bool = False,
+                                   pipe: Optional[aioredis.client.Pipeline] = None):
         """
         state_type: 'positions' or 'orders'
+        pipe: если передан, команда ставится в очередь пайплайна (execute делает вызывающий)
         """
-        key = f"strategy:{strategy_id}:{state_type}"
-        if remove:
-            self.r.hdel(key, symbol)
+        key = self._state_key(strategy_id, state_type)
+        if pipe is not None:
+            if remove:
+                pipe.hdel(key, symbol)
+            else:
+                pipe.hset(key, symbol, orjson.dumps(data))
+        elif remove:
+            await self.r.hdel(key, symbol)
         else:
-            self.r.hset(key, symbol, json.dumps(data))
+            await self.r.hset(key, symbol, orjson.dumps(data))
 
 if __name__ == "__main__":
     redis_host = os.getenv('REDIS_HOST', 'redis')
@@ -1,19 +1,24 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 import redis
-import json
+import redis.asyncio as aioredis
 import asyncio
+import msgpack
+import orjson
 import os
-from typing import List, Dict, Any, Optional
+import threading
+from typing import List, Dict, Any, Optional, Set, Tuple
+from cachetools import TTLCache, cached
 from pydantic import BaseModel
 
 from events import (
-    get_meta_key, get_candles_key, CH_STRATEGY_EVENTS,
+    get_meta_key, get_candles_key, get_state_key, CH_STRATEGY_EVENTS, STRATEGY_INDEX_KEY,
     StrategyMetadata, CandleUpdateEvent
 )
 from storage import TradeStorage
 
-app = FastAPI(title="Crypto Strategy API")
+app = FastAPI(title="Crypto Strategy API", default_response_class=ORJSONResponse)
 
 # CORS for SvelteKit
 app.add_middleware(
@@ -25,7 +30,16 @@ app.add_middleware(
 )
 
 # Redis & Storage
-r = redis.Redis(host=os.getenv('REDIS_HOST', 'redis'), port=6379, db=0, decode_responses=True)
+REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
+# Общий ограниченный пул для команд REST-эндпоинтов (они выполняются в threadpool)
+POOL = redis.BlockingConnectionPool(host=REDIS_HOST, port=6379, db=0, max_connections=32, decode_responses=True)
+r = redis.Redis(connection_pool=POOL)
+# Клиент без декодирования: отдает сырые bytes для ответов, которые пробрасываются как есть
+BYTES_POOL = redis.BlockingConnectionPool(host=REDIS_HOST, port=6379, db=0, max_connections=32, decode_responses=False)
+r_bytes = redis.Redis(connection_pool=BYTES_POOL)
+# Отдельное асинхронное соединение только под pub/sub: подписка не делит сокет с командами.
+# События в канале закодированы MessagePack, поэтому без decode_responses
+r_sub = aioredis.Redis(host=REDIS_HOST, port=6379, db=0, decode_responses=False)
 db_path = os.getenv("DB_PATH", "trades.db")
 storage = TradeStorage(db_path)
 
@@ -33,6 +47,8 @@ class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, List[WebSocket]] = {}
         self.subscriptions: Dict[WebSocket, str] = {} # WebSocket -> current selected symbol
+        # Обратный индекс: (strategy_id, symbol) -> подписанные на график WebSocket
+        self.subs_by_symbol: Dict[Tuple[str, str], Set[WebSocket]] = {}
 
     async def connect(self, websocket: WebSocket, strategy_id: str):
         await websocket.accept()
@@ -41,26 +57,62 @@ class ConnectionManager:
         self.active_connections[strategy_id].append(websocket)
 
     def disconnect(self, websocket: WebSocket, strategy_id: str):
-        if strategy_id in self.active_connections:
-            self.active_connections[strategy_id].remove(websocket)
-        if websocket in self.subscriptions:
-            del self.subscriptions[websocket]
+        connections = self.active_connections.get(strategy_id)
+        if connections and websocket in connections:
+            connections.remove(websocket)
+        self._unsubscribe(websocket, strategy_id)
+
+    def select_symbol(self, websocket: WebSocket, strategy_id: str, symbol: str):
+        self._unsubscribe(websocket, strategy_id)
+        self.subscriptions[websocket] = symbol
+        self.subs_by_symbol.setdefault((strategy_id, symbol), set()).add(websocket)
+
+    def _unsubscribe(self, websocket: WebSocket, strategy_id: str):
+        old_symbol = self.subscriptions.pop(websocket, None)
+        if old_symbol is None:
+            return
+        subscribers = self.subs_by_symbol.get((strategy_id, old_symbol))
+        if subscribers is not None:
+            subscribers.discard(websocket)
+            if not subscribers:
+                del self.subs_by_symbol[(strategy_id, old_symbol)]
 
     async def send_personal_message(self, message: dict, websocket: WebSocket):
         await websocket.send_json(message)
 
     async def broadcast_strategy(self, strategy_id: str, message: dict):
-        if strategy_id in self.active_connections:
-            for connection in self.active_connections[strategy_id]:
-                await connection.send_json(message)
+        targets = [(strategy_id, ws) for ws in self.active_connections.get(strategy_id, [])]
+        await self._send_payload(targets, orjson.dumps(message).decode())
+
+    async def broadcast_symbol(self, strategy_id: str, symbol: str, message: dict):
+        """Отправляет сообщение только клиентам, у которых выбран этот символ."""
+        subscribers = self.subs_by_symbol.get((strategy_id, symbol))
+        if not subscribers:
+            return
+        targets = [(strategy_id, ws) for ws in subscribers]
+        await self._send_payload(targets, orjson.dumps(message).decode())
 
     async def broadcast_all(self, message: dict):
-        for strategy_id in self.active_connections:
-            for connection in self.active_connections[strategy_id]:
-                try:
-                    await connection.send_json(message)
-                except:
-                    pass
+        targets = [
+            (strategy_id, ws)
+            for strategy_id, connections in self.active_connections.items()
+            for ws in connections
+        ]
+        await self._send_payload(targets, orjson.dumps(message).decode())
+
+    async def _send_payload(self, targets: List[Tuple[str, WebSocket]], payload: str):
+        """
+        Отправляет заранее сериализованное сообщение всем адресатам параллельно.
+        Соединения, на которых отправка упала, отключаются.
+        """
+        if not targets:
+            return
+        results = await asyncio.gather(
+            *[ws.send_text(payload) for _, ws in targets], return_exceptions=True
+        )
+        for (strategy_id, ws), result in zip(targets, results):
+            if isinstance(result, Exception):
+                self.disconnect(ws, strategy_id)
 
 manager = ConnectionManager()
 
@@ -68,16 +120,17 @@ manager = ConnectionManager()
 
 @app.get("/strategies")
 def list_strategies():
-    keys = r.keys("strategy:*:meta")
+    pipe = r.pipeline(transaction=False)
+    for sid in r.smembers(STRATEGY_INDEX_KEY):
+        pipe.hgetall(get_meta_key(sid))
     strategies = []
-    for key in keys:
-        meta = r.hgetall(key)
+    for meta in pipe.execute():
         if meta:
             # Parse bit-encoded/json fields
             for field in ['symbols', 'timeframes', 'indicators', 'custom_settings']:
                 if field in meta:
                     try:
-                        meta[field] = json.loads(meta[field])
+                        meta[field] = orjson.loads(meta[field])
                     except:
                         pass
             strategies.append(meta)
@@ -85,40 +138,64 @@ def list_strategies():
 
 @app.get("/instruments")
 def list_instruments():
+    strategy_ids = r.smembers(STRATEGY_INDEX_KEY)
+    return _collect_instruments(tuple(sorted(strategy_ids)))
+
+@cached(TTLCache(maxsize=128, ttl=1.0), lock=threading.Lock())
+def _collect_instruments(strategy_ids: Tuple[str, ...]) -> List[dict]:
+    """
+    Собирает сводку по инструментам. Все чтения из Redis идут двумя пайплайнами
+    (метаданные, затем состояние + последняя свеча), результат кешируется на 1с.
+    """
     # 1. Get all strategies and their metadata
-    strategy_keys = r.keys("strategy:*:meta")
+    pipe = r.pipeline(transaction=False)
+    for sid in strategy_ids:
+        pipe.hgetall(get_meta_key(sid))
     strategies_meta = {}
-    for key in strategy_keys:
-        sid = key.split(":")[1]
-        meta = r.hgetall(key)
-        try:
-            meta['symbols'] = json.loads(meta.get('symbols', '[]'))
-        except:
-            meta['symbols'] = []
+    for sid, meta in zip(strategy_ids, pipe.execute()):
+        if not meta:
+            continue
+        for field in ['symbols', 'timeframes']:
+            try:
+                meta[field] = orjson.loads(meta.get(field, '[]'))
+            except:
+                meta[field] = []
         strategies_meta[sid] = meta
 
-    # 2. Consolidate symbols
+    # 2. Queue active state for every strategy and the last candle for the
+    # first strategy that lists each symbol
+    pipe = r.pipeline(transaction=False)
+    price_sources = {}
+    for sid, meta in strategies_meta.items():
+        pipe.hgetall(get_state_key(sid, "orders"))
+        pipe.hgetall(get_state_key(sid, "positions"))
+        tfs = meta.get('timeframes', [])
+        for sym in meta.get('symbols', []):
+            if sym not in price_sources:
+                price_sources[sym] = bool(tfs)
+                if tfs:
+                    pipe.lindex(get_candles_key(sid, sym, tfs[0]), -1)
+    results = iter(pipe.execute())
+
+    # 3. Consolidate symbols
     instruments_map = {}
     for sid, meta in strategies_meta.items():
         symbols = meta.get('symbols', [])
         
         # Get currently active state for this strategy
-        strategy_orders = r.hgetall(f"strategy:{sid}:orders")
-        strategy_positions = r.hgetall(f"strategy:{sid}:positions")
+        strategy_orders = next(results)
+        strategy_positions = next(results)
 
         for sym in symbols:
             if sym not in instruments_map:
                 # Try to get last price from the first available strategy's candle history
                 last_price = 0.0
-                tfs = meta.get('timeframes', [])
-                if tfs:
-                    c_key = get_candles_key(sid, sym, tfs[0])
-                    last_c = r.lindex(c_key, -1)
-                    if last_c:
-                        try:
-                            last_price = json.loads(last_c).get('close', 0.0)
-                        except:
-                            pass
+                last_c = next(results) if price_sources[sym] else None
+                if last_c:
+                    try:
+                        last_price = orjson.loads(last_c).get('close', 0.0)
+                    except:
+                        pass
 
                 instruments_map[sym] = {
                     "symbol": sym,
@@ -144,9 +221,10 @@ def list_instruments():
 @app.get("/strategies/{strategy_id}/candles/{symbol}/{tf}")
 def get_historical_candles(strategy_id: str, symbol: str, tf: str, limit: int = 1000):
     key = get_candles_key(strategy_id, symbol, tf)
-    # Candles are stored as a list of JSON strings in Redis
-    candles_raw = r.lrange(key, -limit, -1)
-    return [json.loads(c) for c in candles_raw]
+    # Candles are stored as a list of JSON strings in Redis — склеиваем их
+    # в JSON-массив без разбора и повторной сериализации
+    candles_raw = r_bytes.lrange(key, -limit, -1)
+    return Response(content=b"[" + b",".join(candles_raw) + b"]", media_type="application/json")
 
 @app.get("/strategies/{strategy_id}/trades")
 def get_trades(strategy_id: str, symbol: Optional[str] = None):
@@ -157,47 +235,56 @@ def get_instrument_state(strategy_id: str, symbol: str):
     """
     Returns current position and pending order for a specific symbol in a strategy
     """
-    pos = r.hget(f"strategy:{strategy_id}:positions", symbol)
-    order = r.hget(f"strategy:{strategy_id}:orders", symbol)
+    pos = r.hget(get_state_key(strategy_id, "positions"), symbol)
+    order = r.hget(get_state_key(strategy_id, "orders"), symbol)
     
     return {
-        "position": json.loads(pos) if pos else None,
-        "order": json.loads(order) if order else None
+        "position": orjson.loads(pos) if pos else None,
+        "order": orjson.loads(order) if order else None
     }
 
 # --- WEBSOCKET ---
 
 async def redis_listener():
-    pubsub = r.pubsub()
-    pubsub.subscribe(CH_STRATEGY_EVENTS)
+    pubsub = r_sub.pubsub()
+    await pubsub.subscribe(CH_STRATEGY_EVENTS)
+    backoff = 1
     
     while True:
         try:
-            message = pubsub.get_message(ignore_subscribe_messages=True)
-            if message:
-                data = json.loads(message['data'])
-                event_type = data.get('event_type')
-                strategy_id = data.get('strategy_id')
-                
-                if event_type == "CandleUpdateEvent":
-                    symbol = data.get('symbol')
-                    # Отправляем цену во все вачлисты
-                    await broadcast_watchlist_ping(symbol, data)
-                    # Отправляем полную свечу только подписанным на график
-                    await notify_candle_update(strategy_id, symbol, data)
-                
-                elif event_type in ["OrderExecutionEvent", "PositionStateEvent", "TradeTerminalEvent", "StrategyMetadataUpdateEvent"]:
-                    # Глобальное обновление для всех клиентов (обновить статусы)
-                    await manager.broadcast_all({
-                        "type": "update",
-                        "event": event_type,
-                        "data": data
-                    })
-
-            await asyncio.sleep(0.01)
+            async for message in pubsub.listen():
+                backoff = 1
+                if message['type'] != 'message':
+                    continue
+                try:
+                    await dispatch_event(msgpack.unpackb(message['data'], raw=False))
+                except Exception as e:
+                    # Ошибка в одном событии не должна тормозить поток остальных
+                    print(f"Redis listener error: {e}")
         except Exception as e:
-            print(f"Redis listener error: {e}")
-            await asyncio.sleep(1)
+            # Сбой соединения/подписки: переподключение с экспоненциальной задержкой
+            print(f"Redis listener connection error: {e}, retrying in {backoff}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+async def dispatch_event(data: dict):
+    event_type = data.get('event_type')
+    strategy_id = data.get('strategy_id')
+    
+    if event_type == "CandleUpdateEvent":
+        symbol = data.get('symbol')
+        # Отправляем цену во все вачлисты
+        await broadcast_watchlist_ping(symbol, data)
+        # Отправляем полную свечу только подписанным на график
+        await notify_candle_update(strategy_id, symbol, data)
+    
+    elif event_type in ["OrderExecutionEvent", "PositionStateEvent", "TradeTerminalEvent", "StrategyMetadataUpdateEvent"]:
+        # Глобальное обновление для всех клиентов (обновить статусы)
+        await manager.broadcast_all({
+            "type": "update",
+            "event": event_type,
+            "data": data
+        })
 
 async def broadcast_watchlist_ping(symbol: str, data: dict):
     ping = {
@@ -209,17 +296,12 @@ async def broadcast_watchlist_ping(symbol: str, data: dict):
     await manager.broadcast_all(ping)
 
 async def notify_candle_update(strategy_id: str, symbol: str, data: dict):
-    if strategy_id not in manager.active_connections:
-        return
-        
-    for ws in manager.active_connections[strategy_id]:
-        if manager.subscriptions.get(ws) == symbol:
-            await ws.send_json({
-                "type": "candle_update",
-                "strategy_id": strategy_id,
-                "symbol": symbol,
-                "data": data
-            })
+    await manager.broadcast_symbol(strategy_id, symbol, {
+        "type": "candle_update",
+        "strategy_id": strategy_id,
+        "symbol": symbol,
+        "data": data
+    })
 
 @app.websocket("/ws/{strategy_id}")
 async def websocket_endpoint(websocket: WebSocket, strategy_id: str):
@@ -230,7 +312,7 @@ async def websocket_endpoint(websocket: WebSocket, strategy_id: str):
             data = await websocket.receive_json()
             if data.get("action") == "select_symbol":
                 symbol = data.get("symbol")
-                manager.subscriptions[websocket] = symbol
+                manager.select_symbol(websocket, strategy_id, symbol)
                 print(f"Client subscribed to {symbol} in strategy {strategy_id}")
     except WebSocketDisconnect:
         manager.disconnect(websocket, strategy_id)
@@ -1,20 +1,45 @@
 import redis
-import json
+import redis.asyncio as aioredis
+import msgpack
 import os
 import threading
-from typing import Callable, Dict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+def _to_builtin(obj):
+    """msgpack fallback: стратегии нередко передают numpy-скаляры из DataFrame."""
+    if hasattr(obj, "item"):
+        return obj.item()
+    raise TypeError(f"Cannot serialize {type(obj).__name__}")
 
 class EventBus:
     def __init__(self, host='redis', port=6379, db=0):
+        self.host, self.port, self.db = host, port, db
         self.redis = redis.Redis(host=host, port=port, db=db, decode_responses=True)
-        self.pubsub = self.redis.pubsub()
+        # Payload событий — MessagePack (bytes), поэтому подписка идет через клиент без декодирования
+        self._sub_redis = redis.Redis(host=host, port=port, db=db, decode_responses=False)
+        self.pubsub = self._sub_redis.pubsub()
         self.handlers: Dict[str, list[Callable]] = {}
         self.running = False
         self.thread = None
 
+    @staticmethod
+    def pack(event_data: dict) -> bytes:
+        """Encode a dictionary as the MessagePack payload used on the bus."""
+        return msgpack.packb(event_data, use_bin_type=True, default=_to_builtin)
+
     def publish(self, topic: str, event_data: dict):
-        """Publish a dictionary as a JSON string to a topic."""
-        self.redis.publish(topic, json.dumps(event_data))
+        """Publish a dictionary as a MessagePack payload to a topic."""
+        self.redis.publish(topic, self.pack(event_data))
+
+    def publish_pipelined(self, topic: str, event_data: dict, writes: Callable[[Any], None]):
+        """
+        Publish an event together with related Redis writes in one round trip:
+        writes(pipe) queues the commands, the publish is queued after them.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        writes(pipe)
+        pipe.publish(topic, self.pack(event_data))
+        pipe.execute()
 
     def subscribe(self, topic: str, handler: Callable):
         """Subscribe to a topic with a callback handler."""
@@ -29,27 +54,67 @@ class EventBus:
         self.thread = threading.Thread(target=self._listen, daemon=True)
         self.thread.start()
 
+    @staticmethod
+    def _decode(message: dict) -> Optional[Tuple[str, dict]]:
+        """Decode a pub/sub message into (topic, data); None if the payload is not MessagePack."""
+        topic = message['channel'].decode()
+        try:
+            return topic, msgpack.unpackb(message['data'], raw=False)
+        except (ValueError, msgpack.UnpackException):
+            print(f"Failed to decode message on {topic}")
+            return None
+
+    @staticmethod
+    def _drain_batch(pubsub, max_n: int = 128, timeout: float = 1.0) -> List[dict]:
+        """
+        Wait up to `timeout` for the first message, then collect whatever is
+        already buffered without blocking, up to `max_n` data messages.
+        """
+        batch = []
+        message = pubsub.get_message(timeout=timeout)
+        while message is not None:
+            if message['type'] == 'message':
+                batch.append(message)
+                if len(batch) >= max_n:
+                    break
+            message = pubsub.get_message(timeout=0)
+        return batch
+
     def _listen(self):
         """Internal listener loop."""
-        for message in self.pubsub.listen():
-            if not self.running:
-                break
-            if message['type'] == 'message':
-                topic = message['channel']
-                try:
-                    data = json.loads(message['data'])
-                    if topic in self.handlers:
-                        for handler in self.handlers[topic]:
-                            try:
-                                handler(data)
-                            except Exception as e:
-                                print(f"Error handling message on {topic}: {e}")
-                except json.JSONDecodeError:
-                    print(f"Failed to decode message on {topic}")
+        while self.running:
+            batch = self._drain_batch(self.pubsub)
+            for decoded in [self._decode(message) for message in batch]:
+                if decoded is None:
+                    continue
+                topic, data = decoded
+                for handler in self.handlers.get(topic, ()):
+                    try:
+                        handler(data)
+                    except Exception as e:
+                        print(f"Error handling message on {topic}: {e}")
+
+    async def consume(self, *topics: str) -> AsyncIterator[Tuple[str, dict]]:
+        """
+        Async alternative to handlers + listener thread: yields decoded
+        (topic, data) pairs. Defaults to the topics that have handlers.
+        """
+        client = aioredis.Redis(host=self.host, port=self.port, db=self.db, decode_responses=False)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(*(topics or tuple(self.handlers)))
+        try:
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    decoded = self._decode(message)
+                    if decoded is not None:
+                        yield decoded
+        finally:
+            await pubsub.aclose()
+            await client.aclose()
 
     def stop(self):
         """Stop the listener thread."""
         self.running = False
         self.pubsub.unsubscribe()
         self.pubsub.close()
-        # Thread will exit on next message or can be left to daemon
+        # Thread exits after its current get_message timeout
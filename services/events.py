@@ -23,10 +23,15 @@ class BaseEvent(BaseModel):
 REDIS KEY PATTERNS & CHANNELS:
 """
 CH_STRATEGY_EVENTS = "strategy:events"  # General Pub/Sub channel
+STRATEGY_INDEX_KEY = "strategy:index"  # Set of registered strategy ids
 
 def get_meta_key(strategy_id: str) -> str:
     return f"strategy:{strategy_id}:meta"
 
+def get_state_key(strategy_id: str, state_type: str) -> str:
+    """state_type: 'positions' or 'orders'"""
+    return f"strategy:{strategy_id}:{state_type}"
+
 def get_candles_key(strategy_id: str, symbol: str, tf: str) -> str:
     return f"strategy:{strategy_id}:candles:{symbol}:{tf}"
 
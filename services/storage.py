@@ -1,17 +1,49 @@
 import sqlite3
 import json
+import threading
+import atexit
+from collections import deque
 from datetime import datetime
 from typing import List, Optional
 import os
 
+_INSERT_TRADE = """
+    INSERT INTO trades (strategy_id, symbol, side, entry_price, exit_price, qty, pnl, entry_time, exit_time, metadata)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_INSERT_ORDER = """
+    INSERT OR REPLACE INTO orders (order_id, strategy_id, symbol, side, price, qty, type, status, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_TRADE_COLS = (
+    "id", "strategy_id", "symbol", "side", "entry_price", "exit_price",
+    "qty", "pnl", "entry_time", "exit_time", "metadata",
+)
+_SELECT_TRADES = f"SELECT {', '.join(_TRADE_COLS)} FROM trades WHERE strategy_id = ?"
+_SELECT_TRADES_BY_SYMBOL = _SELECT_TRADES + " AND symbol = ?"
+
 class TradeStorage:
+    # Записи буферизуются и сбрасываются одной транзакцией (executemany)
+    # раз в FLUSH_INTERVAL секунд или при накоплении FLUSH_BATCH строк
+    FLUSH_INTERVAL = 0.2
+    FLUSH_BATCH = 64
+
     def __init__(self, db_path: str = "trades.db"):
         self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._lock = threading.Lock()
+        self._trade_buf: deque = deque()
+        self._order_buf: deque = deque()
+        self._wakeup = threading.Event()
+        # Поток сброса запускается при первой записи: читающим процессам (API) он не нужен
+        self._flusher: Optional[threading.Thread] = None
         self._init_db()
 
     def _init_db(self):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
+        with self._lock:
+            self.conn.execute("""
                 CREATE TABLE IF NOT EXISTS trades (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     strategy_id TEXT,
@@ -26,7 +58,7 @@ class TradeStorage:
                     metadata TEXT
                 )
             """)
-            conn.execute("""
+            self.conn.execute("""
                 CREATE TABLE IF NOT EXISTS orders (
                     order_id TEXT PRIMARY KEY,
                     strategy_id TEXT,
@@ -40,49 +72,84 @@ class TradeStorage:
                 )
             """)
 
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+        atexit.register(self.flush)
+
     def save_trade(self, trade_data: dict):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                INSERT INTO trades (strategy_id, symbol, side, entry_price, exit_price, qty, pnl, entry_time, exit_time, metadata)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                trade_data['strategy_id'],
-                trade_data['symbol'],
-                trade_data['side'],
-                trade_data['entry_price'],
-                trade_data.get('exit_price'),
-                trade_data['qty'],
-                trade_data.get('pnl'),
-                trade_data['entry_time'],
-                trade_data.get('exit_time'),
-                json.dumps(trade_data.get('metadata', {}))
-            ))
+        if self._flusher is None:
+            self._start_flusher()
+        self._trade_buf.append((
+            trade_data['strategy_id'],
+            trade_data['symbol'],
+            trade_data['side'],
+            trade_data['entry_price'],
+            trade_data.get('exit_price'),
+            trade_data['qty'],
+            trade_data.get('pnl'),
+            trade_data['entry_time'],
+            trade_data.get('exit_time'),
+            json.dumps(trade_data.get('metadata', {}))
+        ))
+        if len(self._trade_buf) >= self.FLUSH_BATCH:
+            self._wakeup.set()
 
     def save_order(self, order_data: dict):
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                INSERT OR REPLACE INTO orders (order_id, strategy_id, symbol, side, price, qty, type, status, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                order_data['order_id'],
-                order_data['strategy_id'],
-                order_data['symbol'],
-                order_data['side'],
-                order_data['price'],
-                order_data['qty'],
-                order_data['type'],
-                order_data['status'],
-                order_data.get('created_at', datetime.now().isoformat())
-            ))
+        if self._flusher is None:
+            self._start_flusher()
+        self._order_buf.append((
+            order_data['order_id'],
+            order_data['strategy_id'],
+            order_data['symbol'],
+            order_data['side'],
+            order_data['price'],
+            order_data['qty'],
+            order_data['type'],
+            order_data['status'],
+            order_data.get('created_at', datetime.now().isoformat())
+        ))
+        if len(self._order_buf) >= self.FLUSH_BATCH:
+            self._wakeup.set()
+
+    def flush(self):
+        """Записывает накопленные строки одной транзакцией."""
+        with self._lock:
+            trades = [self._trade_buf.popleft() for _ in range(len(self._trade_buf))]
+            orders = [self._order_buf.popleft() for _ in range(len(self._order_buf))]
+            if not trades and not orders:
+                return
+            self.conn.execute("BEGIN")
+            try:
+                if trades:
+                    self.conn.executemany(_INSERT_TRADE, trades)
+                if orders:
+                    self.conn.executemany(_INSERT_ORDER, orders)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing trades to SQLite: {e}")
 
     def get_trades(self, strategy_id: str, symbol: Optional[str] = None) -> List[dict]:
-        query = "SELECT * FROM trades WHERE strategy_id = ?"
-        params = [strategy_id]
+        # Чтобы чтение видело собственные ещё не сброшенные записи
+        self.flush()
         if symbol:
-            query += " AND symbol = ?"
-            params.append(symbol)
-        
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            rows = conn.execute(query, params).fetchall()
-            return [dict(row) for row in rows]
+            query, params = _SELECT_TRADES_BY_SYMBOL, (strategy_id, symbol)
+        else:
+            query, params = _SELECT_TRADES, (strategy_id,)
+
+        with self._lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [dict(zip(_TRADE_COLS, row)) for row in rows]
@@ -0,0 +1,89 @@
+"""
+Проверка: дорасчет индикаторов по новым свечам (_update_indicators) дает
+ровно те же значения, что и полный расчет (apply_indicators без symbol).
+
+Один и тот же ряд свечей подается растущим кадром с шагом 1, 7 и 60 свечей,
+а также скользящим окном CHECK_WINDOW свечей (старые отбрасываются, как в
+OHLCVBuffer). Эталон — полный расчет по всей истории до текущей свечи;
+после каждого шага все колонки INDICATOR_COLUMNS сравниваются побитово.
+Запуск: python check_incremental.py (ненулевой код выхода при расхождении).
+"""
+
+import logging
+import sys
+from typing import Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from main import INDICATOR_COLUMNS, TopTrendBreakOut
+
+CHECK_STEPS = (1, 7, 60)
+CHECK_BARS = 600
+CHECK_WARMUP = 200
+CHECK_WINDOW = 300
+BAR_MS = 300_000
+
+
+def _synthetic_bars(n: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    close = 100 + np.cumsum(rng.normal(0, 1, n))
+    open_ = np.r_[close[0], close[:-1]]
+    high = np.maximum(open_, close) + rng.random(n)
+    low = np.minimum(open_, close) - rng.random(n)
+    volume = rng.random(n) * 1000
+    ts = 1_700_000_000_000 + np.arange(n, dtype=np.int64) * BAR_MS
+    return pd.DataFrame(
+        {
+            "timestamp": ts,
+            "open": open_,
+            "high": high,
+            "low": low,
+            "close": close,
+            "volume": volume,
+            "turnover": volume * close,
+        },
+        index=pd.DatetimeIndex(ts * 1_000_000, dtype="datetime64[ns, UTC]", name="datetime"),
+    )
+
+
+def check_incremental(strategy: TopTrendBreakOut, steps: Iterable[int] = CHECK_STEPS) -> List[str]:
+    """Возвращает список расхождений (пустой, если пути совпадают)."""
+    bars = _synthetic_bars(CHECK_BARS)
+    mismatches = []
+    for window in (None, CHECK_WINDOW):
+        first = window or CHECK_WARMUP
+        for step in steps:
+            label = f"window={window} step={step}" if window else f"step={step}"
+            strategy._ind_cache.clear()
+            # Первый кадр считается полностью и сохраняет состояние
+            strategy.apply_indicators(bars.iloc[:first], "CHECK")
+            for end in range(first + step, CHECK_BARS + 1, step):
+                df = bars.iloc[end - window if window else 0:end]
+                state = strategy._ind_cache.get("CHECK")
+                # Вызываем дорасчет напрямую: откат к полному расчету — тоже ошибка
+                incremental = strategy._update_indicators(df, state) if state else None
+                if incremental is None:
+                    mismatches.append(f"{label} bars={end}: дорасчет не выполнен")
+                    break
+                cold = strategy.apply_indicators(bars.iloc[:end]).iloc[-len(df):]
+                for col in INDICATOR_COLUMNS:
+                    if not np.array_equal(
+                        incremental[col].to_numpy(), cold[col].to_numpy(), equal_nan=True
+                    ):
+                        mismatches.append(f"{label} bars={end} {col}")
+    return mismatches
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    strategy = TopTrendBreakOut(test_mode=True)
+    try:
+        mismatches = check_incremental(strategy)
+    finally:
+        strategy.close()
+    if mismatches:
+        print("Дорасчет индикаторов расходится с полным расчетом:")
+        print("\n".join(mismatches[:20]))
+        sys.exit(1)
+    print("OK: дорасчет индикаторов совпадает с полным расчетом")
@@ -6,7 +6,322 @@ from typing import Any, List, Tuple
 
 import numpy as np
 import pandas as pd
-import pandas_ta as ta
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    from numba import njit
+except ImportError:
+    # Без numba ядра работают как обычные numpy/python-функции
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+
+@njit(cache=True, nogil=True)
+def _stochrsi_smoothed(rsi, period, smoothK, smoothD):
+    """
+    StochRSI со сглаживанием K/D за один проход.
+
+    Минимум/максимум окна считаются монотонными очередями (O(N) на весь ряд),
+    SMA для K и D — по кольцевым буферам окна. Окно с NaN дает raw = 0, как и fillna(0).
+    """
+    n = rsi.shape[0]
+    k_out = np.full(n, np.nan)
+    d_out = np.full(n, np.nan)
+    dq_min = np.empty(n, dtype=np.int64)
+    dq_max = np.empty(n, dtype=np.int64)
+    min_head, min_tail = 0, 0
+    max_head, max_tail = 0, 0
+    raw_buf = np.zeros(smoothK)
+    k_buf = np.zeros(smoothD)
+    last_nan = -1
+
+    for i in range(n):
+        x = rsi[i]
+        if np.isnan(x):
+            last_nan = i
+        else:
+            while min_tail > min_head and x <= rsi[dq_min[min_tail - 1]]:
+                min_tail -= 1
+            dq_min[min_tail] = i
+            min_tail += 1
+            while max_tail > max_head and x >= rsi[dq_max[max_tail - 1]]:
+                max_tail -= 1
+            dq_max[max_tail] = i
+            max_tail += 1
+        while min_tail > min_head and dq_min[min_head] <= i - period:
+            min_head += 1
+        while max_tail > max_head and dq_max[max_head] <= i - period:
+            max_head += 1
+
+        raw = 0.0
+        if i >= period - 1 and last_nan <= i - period:
+            mn = rsi[dq_min[min_head]]
+            mx = rsi[dq_max[max_head]]
+            if mx > mn:
+                raw = (x - mn) / (mx - mn)
+
+        # SMA(raw, smoothK) и SMA(K, smoothD): суммы по окну заново, а не накопительные —
+        # значение зависит только от окна, и хвостовой пересчет совпадает с полным
+        raw_buf[i % smoothK] = raw
+        if i < smoothK - 1:
+            continue
+        k = 0.0
+        for t in range(i - smoothK + 1, i + 1):
+            k += raw_buf[t % smoothK]
+        k /= smoothK
+        k_out[i] = k * 100.0
+
+        j = i - (smoothK - 1)
+        k_buf[j % smoothD] = k
+        if j >= smoothD - 1:
+            d = 0.0
+            for t in range(j - smoothD + 1, j + 1):
+                d += k_buf[t % smoothD]
+            d_out[i] = d / smoothD * 100.0
+
+    return k_out, d_out
+
+
+@njit(cache=True, nogil=True)
+def _true_range(h, l, prev_c):
+    """True Range одной свечи."""
+    return max(h - l, abs(h - prev_c), abs(prev_c - l))
+
+
+@njit(cache=True, nogil=True)
+def _wilder_rsi_step(x, prev_x, gain_ema, loss_ema, alpha):
+    """Один шаг RSI (RMA средних роста/падения). Возвращает (rsi, gain_ema, loss_ema)."""
+    diff = x - prev_x
+    if not np.isnan(diff):
+        gain_ema = (1.0 - alpha) * gain_ema + alpha * max(diff, 0.0)
+        loss_ema = (1.0 - alpha) * loss_ema + alpha * max(-diff, 0.0)
+    total = gain_ema + loss_ema
+    rsi = 100.0 * gain_ema / total if total > 0.0 else np.nan
+    return rsi, gain_ema, loss_ema
+
+
+@njit(cache=True, nogil=True)
+def _wilder_rsi(x, length):
+    """
+    RSI по всему ряду (как ta.rsi с mamode="rma").
+
+    Возвращает (rsi, gain_ema, loss_ema) — средние нужны для инкрементального обновления.
+    """
+    n = x.shape[0]
+    rsi = np.full(n, np.nan)
+    gain = np.full(n, np.nan)
+    loss = np.full(n, np.nan)
+    if n < length + 1:
+        return rsi, gain, loss
+
+    # RMA стартует с первого изменения (как ewm(adjust=False))
+    diff = x[1] - x[0]
+    g = max(diff, 0.0)
+    l = max(-diff, 0.0)
+    gain[1], loss[1] = g, l
+    if g + l > 0.0:
+        rsi[1] = 100.0 * g / (g + l)
+    alpha = 1.0 / length
+    for i in range(2, n):
+        rsi[i], g, l = _wilder_rsi_step(x[i], x[i - 1], g, l, alpha)
+        gain[i], loss[i] = g, l
+    return rsi, gain, loss
+
+
+@njit(cache=True, nogil=True)
+def _supertrend_step(h, l, c, tr, atr, prev_upper, prev_lower, prev_dir, alpha, mult):
+    """
+    Один шаг SuperTrend (логика ta.supertrend, ATR через RMA) по готовому True Range.
+
+    Возвращает (trend, dir, atr, upper, lower).
+    """
+    atr += alpha * (tr - atr)
+    hl2 = (h + l) * 0.5
+    upper = hl2 + mult * atr
+    lower = hl2 - mult * atr
+    if c > prev_upper:
+        direction = 1.0
+    elif c < prev_lower:
+        direction = -1.0
+    else:
+        direction = prev_dir
+        if direction > 0 and lower < prev_lower:
+            lower = prev_lower
+        if direction < 0 and upper > prev_upper:
+            upper = prev_upper
+    trend = lower if direction > 0 else upper
+    return trend, direction, atr, upper, lower
+
+
+@njit(cache=True, nogil=True)
+def _supertrend_natr(high, low, close, length, mult, natr_length):
+    """
+    SuperTrend и NATR за один проход: True Range считается один раз на свечу и идет в оба ATR.
+
+    SuperTrend — как ta.supertrend (ATR через RMA с SMA-затравкой),
+    NATR — как ta.natr (ATR через EMA с SMA-затравкой).
+
+    Возвращает (trend, dir, atr, upper, lower, natr, natr_atr);
+    ряды ATR и полос нужны для инкрементального обновления.
+    """
+    n = close.shape[0]
+    trend = np.full(n, np.nan)
+    direction = np.full(n, np.nan)
+    atr = np.full(n, np.nan)
+    upper = np.full(n, np.nan)
+    lower = np.full(n, np.nan)
+    natr = np.full(n, np.nan)
+    natr_atr = np.full(n, np.nan)
+
+    st_ready = n >= length + 1
+    natr_ready = n >= natr_length + 1
+    seed_len = max(length, natr_length)
+    st_alpha = 1.0 / length
+    natr_alpha = 2.0 / (natr_length + 1)
+
+    tr_sum = 0.0
+    d = 1.0
+    for i in range(n):
+        tr = high[i] - low[i] if i == 0 else _true_range(high[i], low[i], close[i - 1])
+        if i < seed_len:
+            tr_sum += tr
+
+        if st_ready:
+            if i == length - 1:
+                # Затравка ATR — среднее True Range первых length свечей
+                atr[i] = tr_sum / length
+                hl2 = (high[i] + low[i]) * 0.5
+                upper[i] = hl2 + mult * atr[i]
+                lower[i] = hl2 - mult * atr[i]
+                trend[i] = lower[i]
+            elif i >= length:
+                trend[i], d, atr[i], upper[i], lower[i] = _supertrend_step(
+                    high[i], low[i], close[i], tr,
+                    atr[i - 1], upper[i - 1], lower[i - 1], d, st_alpha, mult,
+                )
+                direction[i] = d
+
+        if natr_ready:
+            if i == natr_length - 1:
+                natr_atr[i] = tr_sum / natr_length
+            elif i >= natr_length:
+                natr_atr[i] = (1.0 - natr_alpha) * natr_atr[i - 1] + natr_alpha * tr
+            if i >= natr_length - 1:
+                natr[i] = (100.0 / close[i]) * natr_atr[i]
+
+    return trend, direction, atr, upper, lower, natr, natr_atr
+
+
+@njit(cache=True, nogil=True)
+def _vwap_step(tp, vol, day, prev_day, num, den):
+    """Один шаг дневного VWAP. Возвращает (vwap, num, den)."""
+    if day != prev_day:
+        num = 0.0
+        den = 0.0
+    num += tp * vol
+    den += vol
+    vwap = num / den if den != 0.0 else np.nan
+    return vwap, num, den
+
+
+@njit(cache=True, nogil=True)
+def _vwap_daily(tp, vol, day):
+    """
+    Дневной VWAP по всему ряду (как ta.vwap(anchor="D")): накопление сбрасывается при смене дня.
+
+    Возвращает (vwap, num, den); num/den нужны для инкрементального обновления.
+    """
+    n = tp.shape[0]
+    vwap = np.full(n, np.nan)
+    num = np.zeros(n)
+    den = np.zeros(n)
+    s_num = 0.0
+    s_den = 0.0
+    prev_day = day[0] - 1 if n > 0 else 0
+    for i in range(n):
+        vwap[i], s_num, s_den = _vwap_step(tp[i], vol[i], day[i], prev_day, s_num, s_den)
+        num[i] = s_num
+        den[i] = s_den
+        prev_day = day[i]
+    return vwap, num, den
+
+
+@njit(cache=True, nogil=True)
+def _run_argext(values, code, bit, find_max):
+    """
+    Позиции экстремумов values в каждой непрерывной серии свечей, где в code установлен бит bit.
+
+    Серии размечаются на лету по смене бита у соседних свечей, без промежуточных массивов.
+    NaN пропускаются (как fmax/fmin), при равенстве берется первая свеча
+    (как idxmax/idxmin); серия из одних NaN позиции не дает.
+    """
+    n = code.shape[0]
+    out = np.empty((n + 1) // 2, dtype=np.int64)
+    k = 0
+    pos = -1
+    best = np.nan
+    for i in range(n):
+        if code[i] & bit:
+            v = values[i]
+            if v == v and (pos < 0 or (v > best if find_max else v < best)):
+                best = v
+                pos = i
+        elif pos >= 0:
+            # Серия закончилась на предыдущей свече
+            out[k] = pos
+            k += 1
+            pos = -1
+    if pos >= 0:
+        out[k] = pos
+        k += 1
+    return out[:k]
+
+
+def _sma(x: np.ndarray, length: int) -> np.ndarray:
+    """
+    Скользящее среднее: сумма по каждому окну отдельно.
+
+    Как ta.sma: NaN на разогреве (первые length - 1 значений) и в окнах, где есть NaN.
+    Значение зависит только от свечей окна, а не от начала кадра (в отличие от
+    разности накопленных сумм), поэтому дорасчет по скользящему буферу совпадает
+    с полным расчетом побитово.
+    """
+    n = x.shape[0]
+    out = np.full(n, np.nan)
+    if n < length:
+        return out
+    out[length - 1:] = sliding_window_view(x, length).sum(axis=1) / length
+    return out
+
+
+def warmup_kernels() -> None:
+    """
+    Компилирует njit-ядра на типах, с которыми их вызывает стратегия.
+
+    С cache=True результат пишется на диск (__pycache__), поэтому вызов при сборке
+    образа убирает JIT-паузу первого цикла, а при запуске лишь подгружает кеш.
+    """
+    n = 32
+    x = np.linspace(1.0, 2.0, n)
+    # Массивы из DataFrame приходят только для чтения — для numba это отдельная специализация
+    ro = x.copy()
+    ro.flags.writeable = False
+    days = np.zeros(n, dtype=np.int64)
+    code = (np.arange(n) % 3).astype(np.int8)
+    f = np.float64(1.0)
+
+    rsi, _, _ = _wilder_rsi(x, 10)
+    _stochrsi_smoothed(rsi, 10, 3, 3)
+    _wilder_rsi_step(f, f, f, f, f)
+    _true_range(f, f, f)
+    _supertrend_step(f, f, f, f, f, f, f, f, f, f)
+    _vwap_step(f, f, days[0], days[0], f, f)
+    for arr in (x, ro):
+        _supertrend_natr(arr, arr, arr, 10, 2.5, 14)
+        _vwap_daily(x, arr, days)
+        _run_argext(arr, code, 1, True)
 
 
 class Indicators:
@@ -34,35 +349,33 @@ class Indicators:
         Возвращает:
             Tuple[pd.Series, pd.Series]: (StochK, StochD) в диапазоне 0-100.
         """
-        heiken_ashi = pd.DataFrame(index=data_df.index)
-        heiken_ashi["close"] = (
-            data_df["open"] + data_df["high"] + data_df["low"] + data_df["close"]
-        ) / 4
-        
-        # HA Open: (Prev Open + Prev Close) / 2
-        # Для первой свечи используем обычное открытие
-        heiken_ashi["open"] = (data_df["open"].shift(1) + data_df["close"].shift(1)) / 2
-        heiken_ashi.at[heiken_ashi.index[0], "open"] = data_df["open"].iloc[0]
-        
-        heiken_ashi["high"] = data_df[["high", "open", "close"]].max(axis=1)
-        heiken_ashi["low"] = data_df[["low", "open", "close"]].min(axis=1)
+        rsi, _, _ = self._heiken_rsi(data_df, period_rsi)
 
-        # Расчет RSI от HA Close
-        rsi = ta.rsi(heiken_ashi["close"], length=period_rsi)
+        # StochRSI + сглаживание K/D одним проходом
+        stoch_k, stoch_d = _stochrsi_smoothed(rsi, period_rsi, smoothK, smoothD)
+        return (
+            pd.Series(stoch_k, index=data_df.index),
+            pd.Series(stoch_d, index=data_df.index),
+        )
 
-        # Расчет StochRSI
-        min_rsi = rsi.rolling(period_rsi).min()
-        max_rsi = rsi.rolling(period_rsi).max()
-        stochrsi_raw = (rsi - min_rsi) / (max_rsi - min_rsi)
-        
-        # Обработка деления на ноль и бесконечности
-        stochrsi_raw = stochrsi_raw.fillna(0).replace([np.inf, -np.inf], 0)
-
-        # Сглаживание (SMA)
-        stochrsi_K = ta.sma(stochrsi_raw, length=smoothK)
-        stochrsi_D = ta.sma(stochrsi_K, length=smoothD)
+    def _heiken_rsi(
+        self, data_df: pd.DataFrame, period_rsi: int = 14
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        RSI от HA Close.
 
-        return stochrsi_K * 100, stochrsi_D * 100
+        Возвращает:
+            Tuple[np.ndarray, ...]: (RSI, RMA роста, RMA падения).
+        """
+        # HA Close = (O + H + L + C) / 4 не зависит от рекуррентного HA Open,
+        # поэтому остальные HA-ряды не строим
+        ha_close = (
+            data_df["open"].to_numpy(dtype=np.float64)
+            + data_df["high"].to_numpy(dtype=np.float64)
+            + data_df["low"].to_numpy(dtype=np.float64)
+            + data_df["close"].to_numpy(dtype=np.float64)
+        ) * 0.25
+        return _wilder_rsi(ha_close, period_rsi)
 
     def find_stoch_extrema(self, data_df: pd.DataFrame) -> Tuple[List[Any], List[Any]]:
         """
@@ -77,62 +390,51 @@ class Indicators:
         Возвращает:
             Tuple[List, List]: (Список индексов максимумов, Список индексов минимумов).
         """
+        max_high_pos, min_low_pos = self._stoch_extrema_positions(
+            data_df["stochK"].to_numpy(dtype=np.float64),
+            data_df["stochD"].to_numpy(dtype=np.float64),
+            data_df["high"].to_numpy(dtype=np.float64),
+            data_df["low"].to_numpy(dtype=np.float64),
+        )
+        return data_df.index[max_high_pos].tolist(), data_df.index[min_low_pos].tolist()
+
+    def _stoch_extrema_positions(
+        self,
+        stoch_k: np.ndarray,
+        stoch_d: np.ndarray,
+        high: np.ndarray,
+        low: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        То же, что find_stoch_extrema, но на массивах: возвращает позиции свечей.
+        """
         # --- Поиск максимумов (StochK >= StochD) ---
         # Условие: K >= D (и D > 5 для фильтра шума) ИЛИ явная перекупленность (>95)
-        stoch_positive_mask = (
-            (data_df["stochK"] >= data_df["stochD"]) & (data_df["stochD"] > 5.0)
-        ) | ((data_df["stochK"] > 95.0) & (data_df["stochD"] > 95.0))
-        
-        # Группировка последовательных "положительных" областей
-        stoch_group_ids_high = (
-            stoch_positive_mask != stoch_positive_mask.shift(1)
-        ).cumsum()
-        stoch_group_ids_high[~stoch_positive_mask] = np.nan
-        
-        grouped_df_high = data_df[stoch_positive_mask].copy()
-        grouped_df_high["group_id"] = stoch_group_ids_high[stoch_positive_mask]
+        stoch_positive_mask = ((stoch_k >= stoch_d) & (stoch_d > 5.0)) | (
+            (stoch_k > 95.0) & (stoch_d > 95.0)
+        )
+        # --- Условие для минимумов (StochK <= StochD) ---
+        stoch_negative_mask = ((stoch_k <= stoch_d) & (stoch_d < 95.0)) | (
+            (stoch_k < 5.0) & (stoch_d < 5.0)
+        )
+
+        # Обе маски в одном int8: бит 0 — максимумы, бит 1 — минимумы
+        # (маски не взаимоисключающие: при K == D свеча входит в обе, при NaN — ни в одну)
+        code = stoch_positive_mask.view(np.int8) | (stoch_negative_mask.view(np.int8) << 1)
+
+        # Свеча с максимальным High в каждой группе
+        max_high_pos = _run_argext(high, code, 1, True)
 
         # Убираем последнюю группу, если она еще активна (не завершена)
-        if (
-            not grouped_df_high.empty
-            and data_df["stochK"].iloc[-1] >= data_df["stochD"].iloc[-1]
-        ):
-            last_group_id_high = grouped_df_high["group_id"].iloc[-1]
-            grouped_df_high = grouped_df_high[
-                grouped_df_high["group_id"] != last_group_id_high
-            ]
-
-        # Находим индекс свечи с максимальным High в каждой группе
-        max_high_indices = grouped_df_high.loc[
-            grouped_df_high.groupby("group_id")["high"].idxmax()
-        ].index.tolist()
-
-        # --- Поиск минимумов (StochK <= StochD) ---
-        stoch_negative_mask = (
-            (data_df["stochK"] <= data_df["stochD"]) & (data_df["stochD"] < 95.0)
-        ) | ((data_df["stochK"] < 5.0) & (data_df["stochD"] < 5.0))
-        
-        stoch_group_ids_low = (
-            stoch_negative_mask != stoch_negative_mask.shift(1)
-        ).cumsum()
-        stoch_group_ids_low[~stoch_negative_mask] = np.nan
-        
-        grouped_df_low = data_df[stoch_negative_mask].copy()
-        grouped_df_low["group_id"] = stoch_group_ids_low[stoch_negative_mask]
+        if max_high_pos.size and stoch_k[-1] >= stoch_d[-1]:
+            max_high_pos = max_high_pos[:-1]
+
+        # --- Поиск минимумов ---
+        # Свеча с минимальным Low в каждой группе
+        min_low_pos = _run_argext(low, code, 2, False)
 
         # Убираем последнюю группу
-        if (
-            not grouped_df_low.empty
-            and data_df["stochK"].iloc[-1] <= data_df["stochD"].iloc[-1]
-        ):
-            last_group_id_low = grouped_df_low["group_id"].iloc[-1]
-            grouped_df_low = grouped_df_low[
-                grouped_df_low["group_id"] != last_group_id_low
-            ]
-
-        # Находим индекс свечи с минимальным Low в каждой группе
-        min_low_indices = grouped_df_low.loc[
-            grouped_df_low.groupby("group_id")["low"].idxmin()
-        ].index.tolist()
-        
-        return max_high_indices, min_low_indices
+        if min_low_pos.size and stoch_k[-1] <= stoch_d[-1]:
+            min_low_pos = min_low_pos[:-1]
+
+        return max_high_pos, min_low_pos
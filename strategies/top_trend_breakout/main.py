@@ -16,14 +16,19 @@
 - Стратегия получает обратную связь через OrderUpdateEvent и PositionUpdateEvent.
 """
 
-import json
+import asyncio
 import logging
 import os
 import sys
+import threading
 import time
-from typing import Any, Dict, List, Optional, Set
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+import httpx
 import numpy as np
+import orjson
 import pandas as pd
 import pandas_ta as ta
 from pybit.unified_trading import HTTP
@@ -42,7 +47,8 @@ try:
         StrategyMetadataUpdateEvent,
         get_meta_key,
         get_candles_key,
-        CH_STRATEGY_EVENTS
+        CH_STRATEGY_EVENTS,
+        STRATEGY_INDEX_KEY
     )
 except ImportError:
     # Fallback для IDE или специфичных окружений
@@ -57,14 +63,39 @@ except ImportError:
         StrategyMetadataUpdateEvent,
         get_meta_key,
         get_candles_key,
-        CH_STRATEGY_EVENTS
+        CH_STRATEGY_EVENTS,
+        STRATEGY_INDEX_KEY
     )
 
 try:
-    from .indicators import Indicators
+    from .indicators import (
+        Indicators,
+        _sma,
+        _stochrsi_smoothed,
+        _supertrend_natr,
+        _supertrend_step,
+        _true_range,
+        _vwap_daily,
+        _vwap_step,
+        _wilder_rsi_step,
+        warmup_kernels,
+    )
+    from .ohlcv import KLINE_COLUMNS, OHLCVBuffer
     from .test_utils import MockBus, TestDataProvider
 except ImportError:
-    from indicators import Indicators
+    from indicators import (
+        Indicators,
+        _sma,
+        _stochrsi_smoothed,
+        _supertrend_natr,
+        _supertrend_step,
+        _true_range,
+        _vwap_daily,
+        _vwap_step,
+        _wilder_rsi_step,
+        warmup_kernels,
+    )
+    from ohlcv import KLINE_COLUMNS, OHLCVBuffer
     from test_utils import MockBus, TestDataProvider
 
 # Конфигурация из переменных окружения
@@ -72,6 +103,10 @@ REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 STRATEGY_ID = os.getenv("STRATEGY_ID", "TopTrendBreakOut")
 STRATEGY_NAME = os.getenv("STRATEGY_NAME", "Top Trend Breakout")
 TESTNET = os.getenv("BYBIT_TESTNET", "false").lower() == "true"
+BYBIT_REST_URL = "https://api-testnet.bybit.com" if TESTNET else "https://api.bybit.com"
+# Пул соединений к публичному REST API: соединения держатся между опросами, HTTP/2 мультиплексирует запросы
+HTTP_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=20)
+HTTP_TIMEOUT = 10.0
 LOGS_DIR = os.getenv("LOGS_DIR", "logs")
 
 # Настройка логирования
@@ -85,6 +120,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(STRATEGY_ID)
 
+# Колонки индикаторов, которые кешируются между вызовами apply_indicators
+INDICATOR_COLUMNS = ("natr", "stochK", "stochD", "st_trend", "st_dir", "ROC", "volume_sma", "VWAP")
+DAY_MS = 86_400_000
+
+
+def _values(series: Optional[pd.Series], n: int) -> np.ndarray:
+    """Значения индикатора pandas-ta как ndarray (None -> NaN)."""
+    if series is None:
+        return np.full(n, np.nan)
+    return series.to_numpy(dtype=np.float64)
+
+
+def _with_columns(df: pd.DataFrame, cols: Dict[str, np.ndarray]) -> pd.DataFrame:
+    """Добавляет колонки индикаторов одним блоком вместо поштучных вставок."""
+    block = pd.DataFrame(np.column_stack(list(cols.values())), index=df.index, columns=list(cols))
+    existing = [col for col in cols if col in df.columns]
+    if existing:
+        df = df.drop(columns=existing)
+    return pd.concat([df, block], axis=1)
+
 
 class TopTrendBreakOut:
     """
@@ -108,8 +163,14 @@ class TopTrendBreakOut:
         self.klines_interval = 5  # Таймфрейм (минуты)
         self.min_data_for_indicators = 100  # Длина истории для разогрева индикаторов
         self.rsi_period = 10
+        self.natr_period = 14
+        self.st_multiplier = 2.5
+        self.volume_sma_period = 50
         self.risk_percent = 0.01  # Риск на сделку (1%)
         self.leverage = 5.0  # Кредитное плечо
+        self.analysis_workers = os.cpu_count() or 1  # Потоков для анализа символов
+        self.klines_limit = 200  # Длина окна свечей для анализа
+        self.klines_tail = 5  # Свечей в запросе, когда окно уже в буфере
 
         # Утилиты
         self.indicators = Indicators(rsi_period=self.rsi_period)
@@ -134,9 +195,39 @@ class TopTrendBreakOut:
         self.last_ticker_update = 0
         self.last_candle_update = 0
         self.last_processed_timestamps: Dict[str, float] = {}
-
-        # API клиент
+        # Состояние индикаторов на последней закрытой свече: symbol -> dict
+        self._ind_cache: Dict[str, Dict[str, Any]] = {}
+        # Экстремумы StochRSI последней проверки: symbol -> (ключ окна, позиции max, позиции min)
+        self._extrema_cache: Dict[str, Tuple[tuple, np.ndarray, np.ndarray]] = {}
+        # Ключи Redis-списков свечей: symbol -> ключ (интервал у стратегии один)
+        self._candles_keys: Dict[str, str] = {}
+        # Буферы свечей: symbol -> OHLCVBuffer
+        self._ohlcv: Dict[str, OHLCVBuffer] = {}
+        # Заготовка CandleUpdateEvent: модель валидируется один раз, на свечу копируется dict
+        self._candle_tmpl: Dict[str, Any] = CandleUpdateEvent(
+            strategy_id=self.strategy_id, symbol="", tf=str(self.klines_interval),
+            open=0.0, high=0.0, low=0.0, close=0.0, volume=0.0,
+        ).dict()
+        # Метаданные стратегии (dict и поля Hash в JSON) — строятся при первом обновлении
+        self._meta_data: Optional[Dict[str, Any]] = None
+        self._meta_fields: Optional[Dict[str, Any]] = None
+
+        # Анализ символов идет в пуле потоков (njit-ядра отпускают GIL),
+        # обращения к шине сериализуются блокировкой
+        self._executor = ThreadPoolExecutor(max_workers=self.analysis_workers)
+        self._bus_lock = threading.Lock()
+
+        # API клиенты: публичные эндпоинты (свечи, тикеры) — напрямую через httpx
+        # с постоянными соединениями, pybit — для провайдера тестов
         self.http = HTTP(testnet=TESTNET)
+        self._client = httpx.Client(
+            base_url=BYBIT_REST_URL, http2=True, timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS
+        )
+        # Асинхронный клиент привязан к циклу событий, поэтому цикл тоже постоянный
+        self._loop = asyncio.new_event_loop()
+        self._aclient = httpx.AsyncClient(
+            base_url=BYBIT_REST_URL, http2=True, timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS
+        )
         if self.test_mode:
             self.test_provider = TestDataProvider(self.http)
 
@@ -168,53 +259,47 @@ class TopTrendBreakOut:
         # Индикаторы уже рассчитаны в get_historical_data
         klines = df
         
-        # Данные последней свечи
-        try:
-            current_kline = klines.iloc[-1]
-            st_dir = current_kline.get("st_dir", np.nan)
-            st_trend = current_kline.get("st_trend", np.nan)
-            current_close = current_kline["close"]
-        except Exception:
+        # Данные последней свечи: скалярный доступ, без сборки строки DataFrame
+        if not {"st_dir", "st_trend", "cum_volume"}.issubset(klines.columns):
             return
+        st_dir = klines["st_dir"].iat[-1]
+        st_trend = klines["st_trend"].iat[-1]
 
-        if pd.isna(st_dir) or pd.isna(st_trend):
+        # Без направления SuperTrend вход невозможен — экстремумы не ищем
+        if pd.isna(st_dir) or pd.isna(st_trend) or st_dir == 0:
             return
+        current_close = klines["close"].iat[-1]
 
-        # Поиск экстремумов
+        # Поиск экстремумов (позиции свечей)
+        high = klines["high"].to_numpy(dtype=np.float64)
+        low = klines["low"].to_numpy(dtype=np.float64)
         try:
-            max_high_indices, min_low_indices = self.indicators.find_stoch_extrema(klines)
+            max_high_pos, min_low_pos = self._cached_extrema(symbol, klines, high, low)
         except Exception:
             return
 
-        if len(min_low_indices) < 2 or len(max_high_indices) < 2:
+        if len(min_low_pos) < 2 or len(max_high_pos) < 2:
             return
 
-        # Индексы (время) последних свингов
+        # Позиции последних свингов
         # last - самый последний сформированный, prev - предпоследний
-        idx_low_last = min_low_indices[-1]
-        idx_low_prev = min_low_indices[-2]
-        idx_high_last = max_high_indices[-1]
-        idx_high_prev = max_high_indices[-2]
+        idx_low_last = min_low_pos[-1]
+        idx_low_prev = min_low_pos[-2]
+        idx_high_last = max_high_pos[-1]
+        idx_high_prev = max_high_pos[-2]
 
         # Значения цен в экстремумах
-        try:
-            low_last = klines.loc[idx_low_last, "low"]
-            # low_prev = klines.loc[idx_low_prev, "low"] # unused in logic below directly
-            high_last = klines.loc[idx_high_last, "high"]
-            high_prev = klines.loc[idx_high_prev, "high"]
-            
-            # Для Short логики
-            low_prev_for_short = klines.loc[idx_low_prev, "low"]
-        except KeyError:
-            return
+        low_last = low[idx_low_last]
+        high_last = high[idx_high_last]
+        high_prev = high[idx_high_prev]
+        low_prev = low[idx_low_prev]
+
+        # Объем на свинге за O(1) через накопленную сумму (считается в apply_indicators)
+        cum_volume = klines["cum_volume"].to_numpy()
 
-        # Функция расчета объема на свинге
         def get_vol_sum(idx1, idx2):
             start, end = min(idx1, idx2), max(idx1, idx2)
-            try:
-                return klines.loc[start:end, "volume"].sum()
-            except Exception:
-                return 0.0
+            return cum_volume[end] - (cum_volume[start - 1] if start > 0 else 0.0)
 
         vol_last = get_vol_sum(idx_low_last, idx_high_last)
         vol_prev = get_vol_sum(idx_low_prev, idx_high_prev)
@@ -228,12 +313,7 @@ class TopTrendBreakOut:
             if low_last > high_prev:
                 if vol_last < vol_prev:
                     # TP = Размер последнего свинга, спроецированный от Low
-                    task_profit = current_close * 1.02 # fallback
-                    try:
-                        low_prev_val = klines.loc[idx_low_prev, "low"]
-                        task_profit = low_last + (high_last - low_prev_val) # Проекция амплитуды
-                    except:
-                        pass
+                    task_profit = low_last + (high_last - low_prev) # Проекция амплитуды
 
                     sl = st_trend
 
@@ -246,21 +326,38 @@ class TopTrendBreakOut:
         # 2. Понижение структуры: Текущий High < Предыдущий Low
         # 3. Объем падает
         elif st_dir < 0:
-            if high_last < low_prev_for_short:
+            if high_last < low_prev:
                 if vol_last < vol_prev:
                     # TP проекция вниз
-                    task_profit = current_close * 0.98
-                    try:
-                        high_prev_val = klines.loc[idx_high_prev, "high"]
-                        task_profit = high_last - (high_prev_val - low_last)
-                    except:
-                        pass
+                    task_profit = high_last - (high_prev - low_last)
 
                     sl = st_trend
 
                     logger.info(f"[{symbol}] Сигнал OPEN_SHORT. Price={current_close}, SL={sl}, TP={task_profit}")
                     self.send_signal(symbol, "OPEN_SHORT", price=current_close, stop_loss=sl, take_profit=task_profit)
 
+    def _cached_extrema(
+        self, symbol: str, klines: pd.DataFrame, high: np.ndarray, low: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Позиции экстремумов с кешем на символ.
+
+        Закрытые свечи окна не меняются, поэтому результат определяется границами окна
+        и значениями формирующейся свечи: повторная проверка тех же данных берет его из кеша.
+        """
+        stoch_k = klines["stochK"].to_numpy(dtype=np.float64)
+        stoch_d = klines["stochD"].to_numpy(dtype=np.float64)
+        ts = klines["timestamp"].to_numpy()
+        key = (ts[0], ts[-1], stoch_k[-1], stoch_d[-1], high[-1], low[-1])
+
+        cached = self._extrema_cache.get(symbol)
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+
+        max_high_pos, min_low_pos = self.indicators._stoch_extrema_positions(stoch_k, stoch_d, high, low)
+        self._extrema_cache[symbol] = (key, max_high_pos, min_low_pos)
+        return max_high_pos, min_low_pos
+
     # -------------------------------------------------------------------------
     # Торговая логика: Выход (Trailing SL)
     # -------------------------------------------------------------------------
@@ -321,7 +418,8 @@ class TopTrendBreakOut:
         )
 
         try:
-            self.bus.publish("StrategySignalEvent", signal.dict())
+            with self._bus_lock:
+                self.bus.publish("StrategySignalEvent", signal.dict())
         except Exception as e:
             logger.error(f"Не удалось отправить сигнал: {e}")
 
@@ -332,59 +430,343 @@ class TopTrendBreakOut:
             event = StrategySetTPSLEvent(
                 strategy_id=self.strategy_id, symbol=symbol, stop_loss=sl_val
             )
-            self.bus.publish("StrategySetTPSLEvent", event.dict())
+            with self._bus_lock:
+                self.bus.publish("StrategySetTPSLEvent", event.dict())
         except Exception as e:
             logger.error(f"Не удалось отправить обновление SL: {e}")
 
     # -------------------------------------------------------------------------
     # Работа с данными (Data Fetching)
     # -------------------------------------------------------------------------
-    def apply_indicators(self, df: pd.DataFrame) -> pd.DataFrame:
+    def apply_indicators(self, df: pd.DataFrame, symbol: Optional[str] = None) -> pd.DataFrame:
         """
         Рассчитывает технические индикаторы для стратегии.
-        """
-        df = df.copy()
 
-        # 1. Расчет NATR (Normalized Average True Range) для оценки волатильности
-        df['natr'] = ta.natr(df['high'], df['low'], df['close'], length=14)
+        Если передан symbol, состояние индикаторов кешируется: при следующем вызове
+        пересчитываются только новые свечи, полный расчет — лишь при холодном старте.
+        """
+        if symbol is not None:
+            state = self._ind_cache.get(symbol)
+            if state is not None:
+                updated = self._update_indicators(df, state)
+                if updated is not None:
+                    return updated
+
+        n = len(df)
+        high = df["high"].to_numpy(dtype=np.float64)
+        low = df["low"].to_numpy(dtype=np.float64)
+        close = df["close"].to_numpy(dtype=np.float64)
+        volume = df["volume"].to_numpy(dtype=np.float64)
+        cols: Dict[str, np.ndarray] = {}
+
+        # 1. NATR (Normalized Average True Range) для оценки волатильности
+        #    считается вместе с SuperTrend (п. 3) — у них общий True Range
 
         # 2. StochRSI на Heiken Ashi — помогает фильтровать шум и находить зоны перепроданности/перекупленности
         try:
-            df["stochK"], df["stochD"] = self.indicators._heiken_stochrsi(df, self.rsi_period, 3, 3)
+            rsi, _, _ = self.indicators._heiken_rsi(df, self.rsi_period)
+            cols["stochK"], cols["stochD"] = _stochrsi_smoothed(rsi, self.rsi_period, 3, 3)
         except:
-            df["stochK"], df["stochD"] = np.nan, np.nan
+            cols["stochK"], cols["stochD"] = np.full(n, np.nan), np.full(n, np.nan)
 
         # 3. SuperTrend — наш основной фильтр тренда (Up/Down)
+        #    st_trend — цена линии SuperTrend (используем как SL), st_dir — направление (1 Long, -1 Short)
         try:
-            st = ta.supertrend(df["high"], df["low"], df["close"], length=self.rsi_period, multiplier=2.5)
-            if st is not None:
-                st_col = f"SUPERT_{self.rsi_period}_2.5"
-                std_col = f"SUPERTd_{self.rsi_period}_2.5"
-                df["st_trend"] = st.get(st_col, np.nan) # Цена линии SuperTrend (используем как SL)
-                df["st_dir"] = st.get(std_col, np.nan)   # Направление (1 для Long, -1 для Short)
+            cols["st_trend"], cols["st_dir"], _, _, _, cols["natr"], _ = _supertrend_natr(
+                high, low, close, self.rsi_period, self.st_multiplier, self.natr_period
+            )
         except:
-            df["st_trend"], df["st_dir"] = np.nan, np.nan
+            cols["st_trend"], cols["st_dir"], cols["natr"] = np.full(n, np.nan), np.full(n, np.nan), np.full(n, np.nan)
 
         # 4. Вспомогательные индикаторы: ROC (Momentum), VolSMA (сглаживание объема), VWAP (якорь дня)
         try:
-            df["ROC"] = ta.roc(df["close"], length=self.rsi_period)
-            df["volume_sma"] = ta.sma(df["volume"], length=50) # Matching config name
-            df["VWAP"] = ta.vwap(df["high"], df["low"], df["close"], df["volume"], anchor="D")
+            cols["ROC"] = _values(ta.roc(df["close"], length=self.rsi_period), n)
+            cols["volume_sma"] = _sma(volume, self.volume_sma_period) # Matching config name
+            cols["VWAP"], _, _ = _vwap_daily(
+                (high + low + close) / 3.0, volume, df["timestamp"].to_numpy(dtype=np.int64) // DAY_MS
+            )
         except:
             pass
-            
+
         # 5. Экстремумы (маркеры)
+        cols["highex"], cols["lowex"] = self._extrema_markers(high, low, cols["stochK"], cols["stochD"])
+        # Накопленный объем по кадру — для объема на свингах в check_entry_signals
+        cols["cum_volume"] = np.cumsum(volume)
+
+        df = _with_columns(df, cols)
+
+        if symbol is not None:
+            state = self._init_indicator_state(df)
+            if state is not None:
+                self._ind_cache[symbol] = state
+            else:
+                self._ind_cache.pop(symbol, None)
+
+        return df
+
+    def _extrema_markers(
+        self, high: np.ndarray, low: np.ndarray, stoch_k: np.ndarray, stoch_d: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Маркеры экстремумов (highex/lowex): цена в свече-экстремуме, иначе NaN."""
+        highex = np.full(high.shape[0], np.nan)
+        lowex = np.full(low.shape[0], np.nan)
         try:
-            max_high_indices, min_low_indices = self.indicators.find_stoch_extrema(df)
-            df["highex"] = np.nan
-            df["lowex"] = np.nan
-            df.loc[max_high_indices, "highex"] = df.loc[max_high_indices, "high"]
-            df.loc[min_low_indices, "lowex"] = df.loc[min_low_indices, "low"]
+            max_high_pos, min_low_pos = self.indicators._stoch_extrema_positions(stoch_k, stoch_d, high, low)
+            highex[max_high_pos] = high[max_high_pos]
+            lowex[min_low_pos] = low[min_low_pos]
         except:
             pass
+        return highex, lowex
+
+    def _init_indicator_state(self, df: pd.DataFrame) -> Optional[Dict[str, Any]]:
+        """
+        Снимает состояние рекуррентных индикаторов на последней закрытой свече (предпоследняя строка).
+        Последняя строка — формирующаяся свеча, она пересчитывается при каждом вызове.
+        """
+        n = len(df)
+        if n < self.min_data_for_indicators or any(col not in df.columns for col in INDICATOR_COLUMNS):
+            return None
+
+        p = n - 2
+        high = df["high"].to_numpy(dtype=np.float64)
+        low = df["low"].to_numpy(dtype=np.float64)
+        close = df["close"].to_numpy(dtype=np.float64)
+        volume = df["volume"].to_numpy(dtype=np.float64)
+        ts = df["timestamp"].to_numpy(dtype=np.int64)
+
+        rsi, gain_ema, loss_ema = self.indicators._heiken_rsi(df, self.rsi_period)
+        _, _, st_atr, st_upper, st_lower, _, natr_atr = _supertrend_natr(
+            high, low, close, self.rsi_period, self.st_multiplier, self.natr_period
+        )
+
+        # Дневной VWAP: суммы с начала текущих суток
+        days = ts // DAY_MS
+        _, vwap_num, vwap_den = _vwap_daily((high + low + close) / 3.0, volume, days)
+
+        state = {
+            "last_ts": ts[p],
+            "ts": ts[: p + 1],
+            "cols": {col: df[col].to_numpy(dtype=np.float64)[: p + 1] for col in INDICATOR_COLUMNS},
+            # Хвост RSI: окно StochRSI + сглаживание K и D
+            "rsi": rsi[: p + 1][-(self.rsi_period + 3 + 3):],
+            "rsi_gain_ema": gain_ema[p],
+            "rsi_loss_ema": loss_ema[p],
+            "natr_atr": natr_atr[p],
+            "st_atr": st_atr[p],
+            "st_upper": st_upper[p],
+            "st_lower": st_lower[p],
+            "st_dir": df["st_dir"].iat[p],
+            "vwap_day": days[p],
+            "vwap_num": vwap_num[p],
+            "vwap_den": vwap_den[p],
+        }
+        scalars = [v for k, v in state.items() if k.startswith(("rsi_", "natr_", "st_"))]
+        if not np.all(np.isfinite(scalars)):
+            return None
+        return state
+
+    def _update_indicators(self, df: pd.DataFrame, state: Dict[str, Any]) -> Optional[pd.DataFrame]:
+        """
+        Дорасчет индикаторов только для новых свечей от сохраненного состояния.
+        Возвращает None, если данные не стыкуются с кешем (нужен полный пересчет).
+        """
+        n = len(df)
+        if n < self.min_data_for_indicators:
+            return None
+
+        ts = df["timestamp"].to_numpy()
+        # k — число свечей, уже посчитанных ранее
+        k = int(np.searchsorted(ts, state["last_ts"], side="right"))
+        start = len(state["ts"]) - k
+        if k == 0 or k == n or start < 0 or not np.array_equal(state["ts"][start:], ts[:k]):
+            return None
+
+        open_ = df["open"].to_numpy(dtype=np.float64)
+        high = df["high"].to_numpy(dtype=np.float64)
+        low = df["low"].to_numpy(dtype=np.float64)
+        close = df["close"].to_numpy(dtype=np.float64)
+        volume = df["volume"].to_numpy(dtype=np.float64)
+        ha_close = (open_ + high + low + close) * 0.25
+
+        rsi_alpha = 1.0 / self.rsi_period
+        st_alpha = 1.0 / self.rsi_period
+        natr_alpha = 2.0 / (self.natr_period + 1)
+
+        m = n - k
+        new = {col: np.empty(m) for col in INDICATOR_COLUMNS}
+        rsi_new = np.empty(m)
+        s = dict(state)
+        committed = s
+        for j in range(k, n):
+            if j == n - 1:
+                # Формирующаяся свеча не меняет сохраненное состояние
+                committed = dict(s)
+            i = j - k
+
+            rsi_new[i], s["rsi_gain_ema"], s["rsi_loss_ema"] = _wilder_rsi_step(
+                ha_close[j], ha_close[j - 1], s["rsi_gain_ema"], s["rsi_loss_ema"], rsi_alpha
+            )
+
+            # True Range общий для NATR и SuperTrend
+            tr = _true_range(high[j], low[j], close[j - 1])
+            s["natr_atr"] = (1.0 - natr_alpha) * s["natr_atr"] + natr_alpha * tr
+            new["natr"][i] = (100.0 / close[j]) * s["natr_atr"]
+
+            (
+                new["st_trend"][i], new["st_dir"][i], s["st_atr"], s["st_upper"], s["st_lower"]
+            ) = _supertrend_step(
+                high[j], low[j], close[j], tr,
+                s["st_atr"], s["st_upper"], s["st_lower"], s["st_dir"],
+                st_alpha, self.st_multiplier,
+            )
+            s["st_dir"] = new["st_dir"][i]
+
+            day = ts[j] // DAY_MS
+            new["VWAP"][i], s["vwap_num"], s["vwap_den"] = _vwap_step(
+                (high[j] + low[j] + close[j]) / 3.0, volume[j], day, s["vwap_day"], s["vwap_num"], s["vwap_den"]
+            )
+            s["vwap_day"] = day
 
+            # Как ta.roc: без rsi_period предыдущих свечей в кадре значения нет
+            if j < self.rsi_period:
+                new["ROC"][i] = np.nan
+            else:
+                new["ROC"][i] = 100.0 * (close[j] - close[j - self.rsi_period]) / close[j - self.rsi_period]
+
+        # Та же формула, что и при полном расчете, иначе значения расходятся в последних битах
+        new["volume_sma"] = _sma(volume, self.volume_sma_period)[k:]
+
+        # StochRSI зависит от окна RSI — считаем по короткому хвосту
+        rsi_tail = np.concatenate((state["rsi"], rsi_new))
+        stoch_k, stoch_d = _stochrsi_smoothed(rsi_tail, self.rsi_period, 3, 3)
+        new["stochK"] = stoch_k[-m:]
+        new["stochD"] = stoch_d[-m:]
+
+        cols = {col: np.concatenate((state["cols"][col][start:], new[col])) for col in INDICATOR_COLUMNS}
+        cols["highex"], cols["lowex"] = self._extrema_markers(high, low, cols["stochK"], cols["stochD"])
+        cols["cum_volume"] = np.cumsum(volume)
+        df = _with_columns(df, cols)
+
+        committed["last_ts"] = ts[n - 2]
+        committed["ts"] = ts[: n - 1]
+        committed["cols"] = {col: arr[: n - 1] for col, arr in cols.items()}
+        committed["rsi"] = rsi_tail[:-1][-len(state["rsi"]):]
+        state.update(committed)
         return df
 
+    def _parse_klines(self, response: Dict[str, Any]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Разбирает ответ /v5/market/kline в массивы (по возрастанию времени).
+
+        Возвращает (timestamp int64, значения float64 в порядке KLINE_COLUMNS[1:]) или None.
+        """
+        if response.get("retCode") != 0:
+            return None
+        data = response.get("result", {}).get("list", [])
+        if not data:
+            return None
+
+        # Строки -> числа одним astype на весь блок, без промежуточного DataFrame
+        arr = np.array(data, dtype=object)
+        # Bybit отдает свечи от новых к старым: достаточно развернуть
+        arr = arr[::-1]
+        ts = arr[:, 0].astype(np.int64)
+        values = arr[:, 1:7].astype(np.float64)
+        if (np.diff(ts) < 0).any():
+            order = np.argsort(ts, kind="stable")
+            return ts[order], values[order]
+        return ts, values
+
+    def _klines_to_df(self, response: Dict[str, Any]) -> pd.DataFrame:
+        """Преобразует ответ /v5/market/kline в DataFrame с DatetimeIndex (по возрастанию времени)."""
+        klines = self._parse_klines(response)
+        if klines is None:
+            return pd.DataFrame()
+        ts, values = klines
+        # Колонки сразу нужных типов в одном конструкторе, без df.insert
+        return pd.DataFrame(
+            {"timestamp": ts, **dict(zip(KLINE_COLUMNS[1:], values.T))},
+            index=pd.DatetimeIndex(ts * 1_000_000, dtype="datetime64[ns, UTC]", name="datetime"),
+        )
+
+    def _kline_params(self, symbol: str, limit: int) -> Dict[str, Any]:
+        return {
+            "category": "linear",
+            "symbol": symbol,
+            "interval": str(self.klines_interval),
+            "limit": limit,
+        }
+
+    def _public_get(self, path: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """GET к публичному REST API Bybit через постоянный клиент."""
+        response = self._client.get(path, params=params)
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
+    async def _fetch_kline(self, symbol: str, limit: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Асинхронно запрашивает свечи одного символа напрямую из REST API Bybit."""
+        try:
+            response = await self._aclient.get("/v5/market/kline", params=self._kline_params(symbol, limit))
+            response.raise_for_status()
+            return self._parse_klines(orjson.loads(response.content))
+        except Exception as e:
+            logger.error(f"[{symbol}] Исключение при получении данных: {e}")
+            return None
+
+    async def _fetch_all_klines(
+        self, limits: Dict[str, int]
+    ) -> Dict[str, Optional[Tuple[np.ndarray, np.ndarray]]]:
+        """Запрашивает свечи всех символов параллельно (время ≈ самый долгий запрос, а не сумма)."""
+        klines = await asyncio.gather(*(self._fetch_kline(sym, limit) for sym, limit in limits.items()))
+        return dict(zip(limits, klines))
+
+    def fetch_klines(self, symbols: List[str]) -> Dict[str, pd.DataFrame]:
+        """
+        Свечи по списку символов: одним пакетом с биржи или из провайдера тестов.
+
+        С биржи свечи копятся в буфере символа: окно целиком загружается один раз,
+        дальше догружается только хвост из klines_tail свечей.
+        """
+        limit = self.klines_limit
+        if self.test_mode and self.test_provider:
+            return self.test_provider.get_test_historical_data_batch(
+                symbols, str(self.klines_interval), limit
+            )
+
+        # Буферы символов, выбывших из списка, больше не нужны
+        for sym in set(self._ohlcv) - set(symbols):
+            del self._ohlcv[sym]
+
+        limits = {
+            sym: self.klines_tail if len(self._ohlcv.get(sym, ())) >= limit else limit
+            for sym in symbols
+        }
+        fetched = self._loop.run_until_complete(self._fetch_all_klines(limits))
+
+        # Между буфером и хвостом пропуск свечей — перезагружаем окно целиком
+        refetch = {}
+        for sym, klines in fetched.items():
+            if klines is None:
+                continue
+            buf = self._ohlcv.get(sym)
+            if buf is None:
+                buf = self._ohlcv[sym] = OHLCVBuffer(
+                    KLINE_COLUMNS[1:], capacity=limit, step=self.klines_interval * 60_000
+                )
+            if not buf.merge(*klines):
+                buf.clear()
+                refetch[sym] = limit
+        if refetch:
+            fetched.update(self._loop.run_until_complete(self._fetch_all_klines(refetch)))
+            for sym in refetch:
+                if fetched[sym] is not None:
+                    self._ohlcv[sym].merge(*fetched[sym])
+
+        return {
+            sym: self._ohlcv[sym].frame(limit) if fetched[sym] is not None else pd.DataFrame()
+            for sym in symbols
+        }
+
     def get_historical_data(self, symbol: str, limit: int = 200) -> pd.DataFrame:
         """Получает исторические данные и обогащает их индикаторами."""
         interval = str(self.klines_interval)
@@ -394,29 +776,23 @@ class TopTrendBreakOut:
             df = self.test_provider.get_test_historical_data(symbol, interval, limit)
         else:
             try:
-                response = self.http.get_kline(
-                    category="linear", symbol=symbol, interval=interval, limit=limit
-                )
-                if response.get("retCode") == 0:
-                    data = response.get("result", {}).get("list", [])
-                    df = pd.DataFrame(data, columns=["timestamp", "open", "high", "low", "close", "volume", "turnover"])
-                    cols = ["open", "high", "low", "close", "volume"]
-                    df[cols] = df[cols].apply(pd.to_numeric, errors="coerce")
-                    df["timestamp"] = pd.to_numeric(df["timestamp"])
-                    df = df.sort_values("timestamp").reset_index(drop=True)
-                    df["datetime"] = pd.to_datetime(df["timestamp"], unit="ms", utc=True)
-                    df.set_index("datetime", inplace=True)
-                else:
-                    return pd.DataFrame()
+                response = self._public_get("/v5/market/kline", self._kline_params(symbol, limit))
+                df = self._klines_to_df(response)
             except Exception as e:
                 logger.error(f"Исключение при получении данных: {e}")
                 return pd.DataFrame()
 
+        return self.process_klines(symbol, df)
+
+    def process_klines(self, symbol: str, df: pd.DataFrame) -> pd.DataFrame:
+        """Обогащает свечи индикаторами и транслирует новую свечу в UI/агрегатор."""
         if df.empty:
             return df
 
+        interval = str(self.klines_interval)
+
         # Применяем расчет индикаторов (вынесено в отдельный метод)
-        df = self.apply_indicators(df)
+        df = self.apply_indicators(df, symbol)
 
         # --- Логика обработки новой закрытой свечи ---
         last_kline = df.iloc[-1]
@@ -440,35 +816,51 @@ class TopTrendBreakOut:
                 "lowex": float(last_kline["lowex"]) if not pd.isna(last_kline.get("lowex")) else None
             }
             
-            # Создаем событие для Redis Pub/Sub (его поймает API и WebSocket)
-            event = CandleUpdateEvent(
-                strategy_id=self.strategy_id,
-                symbol=symbol,
-                tf=interval,
-                open=float(last_kline["open"]),
-                high=float(last_kline["high"]),
-                low=float(last_kline["low"]),
-                close=float(last_kline["close"]),
-                volume=float(last_kline["volume"]),
-                indicators=indicators_data,
-                timestamp=ts / 1000.0
-            )
+            # Событие CandleUpdateEvent для Redis Pub/Sub (его поймает API и WebSocket):
+            # копия заготовки вместо повторной валидации модели
+            event_dict = self._candle_tmpl.copy()
+            event_dict["event_id"] = str(uuid.uuid4())
+            event_dict["timestamp"] = float(ts) / 1000.0
+            event_dict["symbol"] = symbol
+            event_dict["tf"] = interval
+            event_dict["open"] = float(last_kline["open"])
+            event_dict["high"] = float(last_kline["high"])
+            event_dict["low"] = float(last_kline["low"])
+            event_dict["close"] = float(last_kline["close"])
+            event_dict["volume"] = float(last_kline["volume"])
+            event_dict["indicators"] = indicators_data
             
             # 2. Сохраняем в Redis List для мгновенного доступа фронтенда к истории последних свечей
-            r_key = get_candles_key(self.strategy_id, symbol, interval)
-            self.bus.redis.rpush(r_key, event.json())
-            self.bus.redis.ltrim(r_key, -1000, -1) # Храним последние 1000 свечей
-            
             # 3. Публикуем событие в шину. На это событие реагирует агрегатор для проверки ордеров.
-            self.bus.publish(CH_STRATEGY_EVENTS, event.dict())
+            # Все три команды уходят одним пайплайном (один round-trip вместо трех)
+            r_key = self._candles_keys.get(symbol)
+            if r_key is None:
+                r_key = self._candles_keys[symbol] = get_candles_key(self.strategy_id, symbol, interval)
+
+            def store_candle(pipe):
+                pipe.rpush(r_key, orjson.dumps(event_dict))
+                pipe.ltrim(r_key, -1000, -1) # Храним последние 1000 свечей
+
+            with self._bus_lock:
+                self.bus.publish_pipelined(CH_STRATEGY_EVENTS, event_dict, store_candle)
             
         return df
 
+    def _analyze_symbol(self, symbol: str, raw: pd.DataFrame) -> None:
+        """Индикаторы и проверка сигналов по одному символу (выполняется в пуле потоков)."""
+        try:
+            df = self.process_klines(symbol, raw)
+            if not df.empty:
+                self.check_entry_signals(df, symbol)
+                self.check_exit_signals(df, symbol)
+        except Exception as e:
+            logger.error(f"[{symbol}] Исключение при анализе: {e}")
+
     def update_working_symbols(self):
         """ Обновляет список символов и сохраняет метаданные в Redis. """
         try:
             logger.info("Обновление списка символов...")
-            response = self.http.get_tickers(category="linear")
+            response = self._public_get("/v5/market/tickers", {"category": "linear"})
             if response.get("retCode") != 0:
                 logger.error("Ошибка API при обновлении тикеров")
                 return
@@ -481,38 +873,48 @@ class TopTrendBreakOut:
 
             active = set(self.positions.keys()) | set(self.active_orders.keys())
             self.working_symbols = set(top_symbols) | active
-            indicators_config = TestDataProvider.get_test_indicators_for_plotting()
-            
             # --- Сохранение метаданных в Redis ---
-            meta = StrategyMetadata(
-                strategy_id=self.strategy_id,
-                name=STRATEGY_NAME,
-                description="SuperTrend + Struktur Breakout Strategy",
-                symbols=list(self.working_symbols),
-                timeframes=[str(self.klines_interval)],
-                indicators=indicators_config,
-                custom_settings={
-                    "risk_percent": self.risk_percent,
-                    "leverage": self.leverage
+            # Постоянная часть метаданных собирается и кодируется один раз, дальше меняется только symbols
+            if self._meta_data is None:
+                indicators_config = TestDataProvider.get_test_indicators_for_plotting(copy=True)
+                meta = StrategyMetadata(
+                    strategy_id=self.strategy_id,
+                    name=STRATEGY_NAME,
+                    description="SuperTrend + Struktur Breakout Strategy",
+                    timeframes=[str(self.klines_interval)],
+                    indicators=indicators_config,
+                    custom_settings={
+                        "risk_percent": self.risk_percent,
+                        "leverage": self.leverage
+                    }
+                )
+                self._meta_data = meta.dict()
+                # Hash — плоский словарь: строки как есть, остальное (списки, словари, bool) в JSON; None не пишем
+                self._meta_fields = {
+                    k: v if isinstance(v, str) else orjson.dumps(v)
+                    for k, v in self._meta_data.items()
+                    if v is not None
                 }
-            )
+
+            symbols = list(self.working_symbols)
+            meta_data = {**self._meta_data, "symbols": symbols}
+            meta_dict = {**self._meta_fields, "symbols": orjson.dumps(symbols)}
             # Ключ: strategy:{id}:meta
             meta_key = get_meta_key(self.strategy_id)
-            # Сохраняем как Hash (плоский словарь)
-            meta_dict = meta.dict()
-            # Превращаем сложные объекты в JSON для хранения в Hash
-            for k, v in meta_dict.items():
-                if isinstance(v, (list, dict)):
-                    meta_dict[k] = json.dumps(v)
-            
-            self.bus.redis.hset(meta_key, mapping=meta_dict)
-            
+
             # Публикуем событие об обновлении метаданных
             update_event = StrategyMetadataUpdateEvent(
                 strategy_id=self.strategy_id,
-                metadata=meta.dict()
+                metadata=meta_data
             )
-            self.bus.publish(CH_STRATEGY_EVENTS, update_event.dict())
+
+            def store_meta(pipe):
+                pipe.hset(meta_key, mapping=meta_dict)
+                # Регистрируем стратегию в индексе (API читает его вместо KEYS strategy:*:meta)
+                pipe.sadd(STRATEGY_INDEX_KEY, self.strategy_id)
+
+            with self._bus_lock:
+                self.bus.publish_pipelined(CH_STRATEGY_EVENTS, update_event.dict(), store_meta)
             
             logger.info(f"Активные символы ({len(self.working_symbols)}): {self.working_symbols}")
 
@@ -566,9 +968,20 @@ class TopTrendBreakOut:
     # -------------------------------------------------------------------------
     # Main Loop (Запуск)
     # -------------------------------------------------------------------------
+    def close(self):
+        """Закрывает HTTP-клиенты и их цикл событий."""
+        self._client.close()
+        self._loop.run_until_complete(self._aclient.aclose())
+        self._loop.close()
+
     def start(self):
         """Запуск цикла стратегии."""
         logger.info(f"Запуск стратегии {self.strategy_id}")
+
+        # Компиляция (или загрузка из кеша) njit-ядер до первого цикла анализа
+        t0 = time.time()
+        warmup_kernels()
+        logger.info(f"njit-ядра готовы за {time.time() - t0:.2f}с")
         
         # Подписки
         if not self.test_mode:
@@ -589,16 +1002,17 @@ class TopTrendBreakOut:
 
                 # Анализ рынка (раз в минуту)
                 if now - self.last_candle_update > 60:
-                    for sym in list(self.working_symbols):
-                        df = self.get_historical_data(sym)
-                        if not df.empty:
-                            self.check_entry_signals(df, sym)
-                            self.check_exit_signals(df, sym)
+                    # Свечи по всему списку запрашиваются параллельно одним пакетом
+                    frames = self.fetch_klines(list(self.working_symbols))
+                    # ...и анализируются параллельно по символам
+                    list(self._executor.map(self._analyze_symbol, frames.keys(), frames.values()))
                     self.last_candle_update = now
 
             except KeyboardInterrupt:
                 logger.info("Остановка по Ctrl+C")
                 self.running = False
+                self._executor.shutdown(wait=False)
+                self.close()
             except Exception as e:
                 logger.error(f"Исключение в основном цикле: {e}")
                 time.sleep(5)
@@ -0,0 +1,91 @@
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+# Порядок полей свечи в ответе /v5/market/kline
+KLINE_COLUMNS = ("timestamp", "open", "high", "low", "close", "volume", "turnover")
+
+
+class OHLCVBuffer:
+    """
+    Буфер последних свечей символа в виде отдельных массивов на поле (SoA).
+
+    Массивы имеют длину 2 * capacity: новые свечи дописываются в конец, а при
+    заполнении последние свечи переносятся в начало (амортизированно O(1) на свечу).
+    Поэтому окно всегда непрерывно и читается срезом без перестановок.
+    """
+
+    def __init__(self, fields: Sequence[str], capacity: int = 512, step: int = 0):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        # Длительность свечи в мс: пакет, начинающийся ровно через step после
+        # последней свечи, продолжает буфер без пропуска (0 — требовать перекрытие)
+        self.step = step
+        self.ts = np.zeros(2 * capacity, dtype=np.int64)
+        # Строка на поле: срез data[:, lo:hi] совпадает с раскладкой блока DataFrame
+        self.data = np.empty((len(self.fields), 2 * capacity), dtype=np.float64)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    @property
+    def last_ts(self) -> int:
+        """Время последней (формирующейся) свечи, -1 для пустого буфера."""
+        return int(self.ts[self.end - 1]) if self.end > self.start else -1
+
+    def clear(self):
+        self.start = self.end = 0
+
+    def merge(self, ts: np.ndarray, values: np.ndarray) -> bool:
+        """
+        Дописывает свечи: ts по возрастанию, values — (n, len(fields)).
+
+        Свеча с временем последней свечи буфера перезаписывается (она могла быть
+        еще не закрыта), более старые пропускаются. Если между буфером и пакетом
+        есть пропуск свечей, буфер не меняется и возвращается False.
+        """
+        if ts.shape[0] == 0:
+            return True
+        if self.end == self.start:
+            self._extend(ts, values)
+            return True
+
+        last = self.last_ts
+        if ts[0] > last + self.step:
+            return False
+        k = int(np.searchsorted(ts, last))
+        if k < ts.shape[0] and ts[k] == last:
+            self.data[:, self.end - 1] = values[k]
+            k += 1
+        if k < ts.shape[0]:
+            self._extend(ts[k:], values[k:])
+        return True
+
+    def _extend(self, ts: np.ndarray, values: np.ndarray):
+        m = ts.shape[0]
+        if m >= self.capacity:
+            ts, values, m = ts[-self.capacity:], values[-self.capacity:], self.capacity
+            self.start = self.end = 0
+        elif self.end + m > self.ts.shape[0]:
+            # Сдвигаем хвост в начало, освобождая место под новые свечи
+            keep = min(len(self), self.capacity - m)
+            self.ts[:keep] = self.ts[self.end - keep:self.end]
+            self.data[:, :keep] = self.data[:, self.end - keep:self.end]
+            self.start, self.end = 0, keep
+        self.ts[self.end:self.end + m] = ts
+        self.data[:, self.end:self.end + m] = values.T
+        self.end += m
+        self.start = max(self.start, self.end - self.capacity)
+
+    def frame(self, limit: Optional[int] = None) -> pd.DataFrame:
+        """Последние limit свечей как DataFrame (копия) с колонкой timestamp и DatetimeIndex."""
+        lo = self.start if limit is None else max(self.start, self.end - limit)
+        ts = self.ts[lo:self.end].copy()
+        # Конструктор из словаря копирует колонки, буфер с кадром память не делит
+        return pd.DataFrame(
+            {"timestamp": ts, **dict(zip(self.fields, self.data[:, lo:self.end]))},
+            index=pd.DatetimeIndex(ts * 1_000_000, dtype="datetime64[ns, UTC]", name="datetime"),
+        )
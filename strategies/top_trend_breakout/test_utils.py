@@ -1,10 +1,113 @@
+import itertools
 import logging
-from typing import Any, Dict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Mapping, Optional
 
+import numpy as np
 import pandas as pd  # pyright: ignore[reportMissingImports]
 
+try:
+    from .ohlcv import KLINE_COLUMNS
+except ImportError:
+    from ohlcv import KLINE_COLUMNS
+
+try:
+    import fakeredis  # pyright: ignore[reportMissingImports]
+except ImportError:  # fakeredis нужен только для тестов и может быть не установлен
+    fakeredis = None
+
 logger = logging.getLogger("TestUtils")
 
+# Параллельных запросов истории в get_test_historical_data_batch
+HISTORY_FETCH_WORKERS = 16
+
+
+def _freeze(spec: Mapping[str, Any]) -> Mapping[str, Any]:
+    return MappingProxyType(
+        {k: _freeze(v) if isinstance(v, Mapping) else v for k, v in spec.items()}
+    )
+
+
+def _thaw(spec: Mapping[str, Any]) -> Dict[str, Any]:
+    return {k: _thaw(v) if isinstance(v, Mapping) else v for k, v in spec.items()}
+
+
+# Описание индикаторов для графиков: собирается один раз на модуль
+_INDICATOR_PLOT_SPEC = _freeze({
+    "main": {
+        "st_trend": {
+            "color": "yellow",
+            "linestyle": "-",
+            "label": "ST Trend",
+        },
+        "highex": {
+            "color": "blue",
+            "marker": "^",
+            "label": "High Ex",
+        },
+        "lowex": {
+            "color": "orange",
+            "marker": "v",
+            "label": "Low Ex",
+        },
+    },
+    "volume": {
+        "volume": {
+            "color": "gray",
+            "linestyle": "histogram",
+            "label": "Volume",
+        },
+        "volsma": {
+            "color": "red",
+            "linestyle": "-",
+            "label": "Vol SMA",
+        },
+    },
+    "NATR": {
+        "natr": {
+            "color": "red",
+            "linestyle": "-",
+            "label": "NATR",
+        },
+    },
+    "stochRSI": {
+        "stochk": {
+            "color": "green",
+            "linestyle": "-",
+            "label": "Stoch K",
+        },
+        "stochd": {
+            "color": "red",
+            "linestyle": "--",
+            "label": "Stoch D",
+        },
+        # Дополнительные горизонтальные линии для отдельных графиков
+        "stochrsi_overbought": {
+            "value": 80,
+            "color": "black",
+            "linestyle": ":",
+            "label": "Overbought",
+        },
+        "stochrsi_oversold": {
+            "value": 20,
+            "color": "black",
+            "linestyle": ":",
+            "label": "Oversold",
+        },
+    }
+})
+
+# Пустой результат с той же схемой, что и у непустого (см. get_test_historical_data)
+_EMPTY_KLINES = pd.DataFrame(
+    {
+        "timestamp": np.empty(0, dtype=np.int64),
+        **{c: np.empty(0) for c in KLINE_COLUMNS[1:]},
+    },
+    index=pd.DatetimeIndex([], dtype="datetime64[ns, UTC]", name="timestamp"),
+)
+
 
 class _SimpleRedis:
     """Простейшая реализация get/set/delete для тестов.
@@ -15,6 +118,8 @@ class _SimpleRedis:
     - delete(key)
     """
 
+    __slots__ = ("_store",)
+
     def __init__(self):
         self._store: Dict[str, Any] = {}
 
@@ -25,46 +130,99 @@ class _SimpleRedis:
         self._store[key] = value
 
     def delete(self, key: str):
-        if key in self._store:
-            del self._store[key]
+        self._store.pop(key, None)
+
+
+def _make_redis():
+    """
+    Redis для MockBus: при установленном fakeredis — отдельный in-memory сервер
+    с настоящей семантикой Redis (pipeline, списки, хеши, publish), как у
+    EventBus (decode_responses=True); иначе — _SimpleRedis с get/set/delete.
+    """
+    if fakeredis is None:
+        return _SimpleRedis()
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
 
 
 class MockBus:
     """In-memory pub/sub для тестов.
 
     Поведение:
-    - хранит подписчиков в памяти (topic -> [handlers])
+    - хранит подписчиков в памяти (topic -> {token: handler})
     - при `publish` синхронно вызывает зарегистрированные обработчики
     - сохраняет историю опубликованных сообщений в `published`
-    - предоставляет объект `redis` с get/set/delete для тестов
+      (при заданном history_cap — только последние history_cap сообщений)
+    - предоставляет объект `redis` для тестов (fakeredis или get/set/delete, см. _make_redis)
     """
 
-    def __init__(self):
-        # topic -> [handler]
-        self._subscribers: dict = {}
-        # список кортежей (topic, data) для проверок в тестах
-        self.published: list = []
-        # объект с интерфейсом get/set/delete, совместимый с кодом, ожидающим redis-подобный объект
-        self.redis = _SimpleRedis()
+    def __init__(self, history_cap: Optional[int] = None):
+        # topic -> {token: handler}: каждая подписка отдельно, как в EventBus;
+        # dict сохраняет порядок подписки и удаляет по токену за O(1)
+        self._subscribers: defaultdict = defaultdict(dict)
+        # (topic, handler) -> токены его подписок по порядку, для unsubscribe
+        self._tokens: defaultdict = defaultdict(deque)
+        self._next_token = itertools.count()
+        # topic -> id; по id лежит неизменяемый снимок обработчиков для publish.
+        # Подписка/отписка только сбрасывают его в None, пересборка — в publish
+        self._topic_ids: dict = {}
+        self._handlers_by_id: list = []
+        # кортежи (topic, data) для проверок в тестах; с history_cap — кольцевой буфер
+        self._history_cap = history_cap
+        self.published = [] if history_cap is None else deque(maxlen=history_cap)
+        # redis-подобный объект для кода, который пишет в Redis через шину
+        self.redis = _make_redis()
 
     def publish(self, topic, data):
         # Сохраняем для тестовой инспекции
+        self.published.append((topic, data))
+        tid = self._topic_ids.get(topic)
+        if tid is None:
+            return
+        handlers = self._handlers_by_id[tid]
+        if handlers is None:
+            handlers = self._handlers_by_id[tid] = tuple(self._subscribers[topic].values())
+        # Первый упавший обработчик прерывает рассылку, как и раньше
         try:
-            self.published.append((topic, data))
-            handlers = list(self._subscribers.get(topic, []))
             for handler in handlers:
-                try:
-                    handler(data)
-                except Exception as e:
-                    # Логируем и пробрасываем, чтобы тесты могли увидеть ошибку
-                    logger.exception(f"Error in handler for topic '{topic}': {e}")
-                    raise
+                handler(data)
         except Exception:
-            # Защита от неожиданных ошибок при публикации
+            # Логируем и пробрасываем, чтобы тесты могли увидеть ошибку
+            logger.exception("Error in handler for topic '%s'", topic)
             raise
 
+    def publish_pipelined(self, topic, data, writes):
+        """
+        Аналог EventBus.publish_pipelined: writes(pipe) выполняется на pipeline
+        fakeredis, а в _SimpleRedis (только get/set/delete) записи пропускаются;
+        событие затем проходит обычный publish.
+        """
+        pipeline = getattr(self.redis, "pipeline", None)
+        if pipeline is not None:
+            pipe = pipeline(transaction=False)
+            writes(pipe)
+            pipe.execute()
+        self.publish(topic, data)
+
     def subscribe(self, topic, handler):
-        self._subscribers.setdefault(topic, []).append(handler)
+        token = next(self._next_token)
+        self._subscribers[topic][token] = handler
+        self._tokens[(topic, handler)].append(token)
+        tid = self._topic_ids.get(topic)
+        if tid is None:
+            tid = self._topic_ids[topic] = len(self._handlers_by_id)
+            self._handlers_by_id.append(None)
+        self._handlers_by_id[tid] = None
+
+    def unsubscribe(self, topic, handler):
+        # Снимает одну (первую) подписку за O(1); поиск по hash/==, поэтому
+        # связанный метод можно передать как self.method
+        tokens = self._tokens.get((topic, handler))
+        if not tokens:
+            return
+        del self._subscribers[topic][tokens.popleft()]
+        if not tokens:
+            del self._tokens[(topic, handler)]
+        self._handlers_by_id[self._topic_ids[topic]] = None
 
     def start(self):
         # Ничего асинхронного не требуется для синхронных тестов
@@ -82,101 +240,61 @@ class TestDataProvider:
             response = self.http.get_kline(
                 category="linear", symbol=symbol, interval=interval, limit=limit
             )
-            if response["retCode"] == 0:
-                data = response["result"]["list"]
-                df = pd.DataFrame(
-                    data,
-                    columns=[
-                        "timestamp",
-                        "open",
-                        "high",
-                        "low",
-                        "close",
-                        "volume",
-                        "turnover",
-                    ],
-                )
-                df["timestamp"] = pd.to_numeric(df["timestamp"])
-                df["open"] = pd.to_numeric(df["open"])
-                df["high"] = pd.to_numeric(df["high"])
-                df["low"] = pd.to_numeric(df["low"])
-                df["close"] = pd.to_numeric(df["close"])
-                df["volume"] = pd.to_numeric(df["volume"])
-                df = df.sort_values("timestamp").reset_index(drop=True)
-                # Set index to datetime for indicators
-                df.set_index(
-                    pd.to_datetime(df["timestamp"], unit="ms", utc=True), inplace=True
-                )
-                return df
-            return pd.DataFrame()
+            if response["retCode"] != 0:
+                return _EMPTY_KLINES.copy(deep=False)
+            data = response["result"]["list"]
+            if not data:
+                return _EMPTY_KLINES.copy(deep=False)
+            # Строки Bybit -> float64 одним преобразованием всего блока.
+            # pyarrow на 200-1000 свечах не быстрее: транспонирование списка
+            # в колонки съедает выигрыш от его разбора строк
+            arr = np.asarray(data, dtype=np.float64).reshape(-1, len(KLINE_COLUMNS))
+            # Bybit отдает свечи от новых к старым: достаточно развернуть,
+            # сортировка — только если порядок вдруг нарушен
+            arr = arr[::-1]
+            if (np.diff(arr[:, 0]) < 0).any():
+                arr = arr[np.argsort(arr[:, 0], kind="stable")]
+            ts = arr[:, 0].astype(np.int64)
+            # Set index to datetime for indicators
+            index = pd.DatetimeIndex(
+                ts * 1_000_000, dtype="datetime64[ns, UTC]", name="timestamp"
+            )
+            # Колонки сразу нужных типов в одном конструкторе: df.insert стоил
+            # больше, чем весь остальной DataFrame. Колонку timestamp (мс) читает
+            # стратегия: VWAP, состояние индикаторов, события свечей
+            values = np.ascontiguousarray(arr[:, 1:].T)
+            return pd.DataFrame(
+                {"timestamp": ts, **dict(zip(KLINE_COLUMNS[1:], values))},
+                index=index,
+                copy=False,
+            )
         except Exception as e:
             logger.error(f"Error fetching history: {e}")
-            return pd.DataFrame()
+            return _EMPTY_KLINES.copy(deep=False)
+
+    def get_test_historical_data_batch(
+        self, symbols: Iterable[str], interval: str = "5", limit: int = 200
+    ) -> Dict[str, pd.DataFrame]:
+        """
+        История по нескольким символам: запросы идут параллельно в потоках
+        (HTTP-клиент синхронный), результат — {symbol: DataFrame}.
+        """
+        symbols = list(dict.fromkeys(symbols))
+        if not symbols:
+            return {}
+        workers = min(HISTORY_FETCH_WORKERS, len(symbols))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            frames = executor.map(
+                lambda sym: self.get_test_historical_data(sym, interval, limit), symbols
+            )
+            return dict(zip(symbols, frames))
 
-    def get_test_indicators_for_plotting(self) -> Dict[str, Any]:
+    @staticmethod
+    def get_test_indicators_for_plotting(copy: bool = False) -> Mapping[str, Any]:
         """
         Возвращает словарь с индикаторами для построения графиков.
+
+        По умолчанию — общий неизменяемый словарь; copy=True дает изменяемую копию
+        из обычных dict (например, для сериализации).
         """
-        return {
-            "main": {
-                "st_trend": {
-                    "color": "yellow",
-                    "linestyle": "-",
-                    "label": "ST Trend",
-                },
-                "highex": {
-                    "color": "blue",
-                    "marker": "^",
-                    "label": "High Ex",
-                },
-                "lowex": {
-                    "color": "orange",
-                    "marker": "v",
-                    "label": "Low Ex",
-                },
-            },
-            "volume": {
-                "volume": {
-                    "color": "gray",
-                    "linestyle": "histogram",
-                    "label": "Volume",
-                },
-                "volsma": {
-                    "color": "red",
-                    "linestyle": "-",
-                    "label": "Vol SMA",
-                },
-            },
-            "NATR": {
-                "natr": {
-                    "color": "red",
-                    "linestyle": "-",
-                    "label": "NATR",
-                },
-            },
-            "stochRSI": {
-                "stochk": {
-                    "color": "green",
-                    "linestyle": "-",
-                    "label": "Stoch K",
-                },
-                "stochd": {
-                    "color": "red",
-                    "linestyle": "--",
-                    "label": "Stoch D",
-                },
-                # Дополнительные горизонтальные линии для отдельных графиков
-                "stochrsi_overbought": {
-                    "value": 80,
-                    "color": "black",
-                    "linestyle": ":",
-                    "label": "Overbought",
-                },
-                "stochrsi_oversold": {
-                    "value": 20,
-                    "color": "black",
-                    "linestyle": ":",
-                    "label": "Oversold",
-                },
-            }
-        }
+        return _thaw(_INDICATOR_PLOT_SPEC) if copy else _INDICATOR_PLOT_SPEC